@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+import argparse
+import os
+
+import synthetic
+
+parser = argparse.ArgumentParser(
+    description="Generate a data directory of synthetic CREDO exports"
+)
+
+parser.add_argument(
+    "--dir", "-d", help="Path to data directory", default="credo-data-export"
+)
+parser.add_argument(
+    "--max-chunk-size",
+    "-m",
+    help="Maximum number of events in each file",
+    type=int,
+    default=100000,
+)
+synthetic.add_scale_arguments(parser)
+
+args = parser.parse_args()
+
+args.dir = args.dir.rstrip("/")
+
+
+def generate_events(scale, data_type):
+    os.makedirs("{}/{}s".format(args.dir, data_type), exist_ok=True)
+    event = synthetic.EVENTS[data_type]
+    last_timestamp = 0
+
+    # Files are named like the exporter names them, export_<since>_<until>
+    for first in range(0, scale.count(data_type), args.max_chunk_size):
+        last = min(first + args.max_chunk_size, scale.count(data_type))
+        since = last_timestamp
+        last_timestamp = synthetic.time_received(scale, data_type, last - 1)
+
+        path = "{}/{}s/export_{}_{}.json".format(
+            args.dir, data_type, since, last_timestamp
+        )
+        with open(path, "w") as f:
+            synthetic.write_export(
+                f, data_type, (event(scale, i) for i in range(first, last))
+            )
+
+    with open("{}/last_exported_{}".format(args.dir, data_type), "w") as f:
+        f.write(str(last_timestamp))
+
+
+def main():
+    scale = synthetic.scale_from_args(args)
+    os.makedirs(args.dir, exist_ok=True)
+
+    for mapping_type in synthetic.MAPPINGS:
+        with open("{}/{}_mapping.json".format(args.dir, mapping_type), "w") as f:
+            synthetic.write_mapping(f, mapping_type, scale)
+
+    for data_type in ["detection", "ping"]:
+        print("Generating {} {}s".format(scale.count(data_type), data_type))
+        generate_events(scale, data_type)
+
+
+if __name__ == "__main__":
+    main()
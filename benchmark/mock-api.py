@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+import argparse
+import io
+import itertools
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import synthetic
+
+parser = argparse.ArgumentParser(
+    description="Local stand-in for the CREDO API serving synthetic data"
+)
+
+parser.add_argument("--port", type=int, default=8080, help="Port to listen on")
+parser.add_argument(
+    "--delay",
+    type=float,
+    default=1,
+    help="Seconds before a requested export becomes available",
+)
+synthetic.add_scale_arguments(parser)
+
+args = parser.parse_args()
+
+scale = synthetic.scale_from_args(args)
+
+TOKEN = uuid.uuid4().hex
+
+exports = {}
+exports_lock = threading.Lock()
+export_ids = itertools.count()
+
+
+def build_data_export(request):
+    data_type = request["data_type"]
+    first, last = synthetic.index_range(
+        scale, data_type, request["since"], request["until"]
+    )
+    last = min(last, first + request["limit"])
+    event = synthetic.EVENTS[data_type]
+
+    f = io.StringIO()
+    synthetic.write_export(f, data_type, (event(scale, i) for i in range(first, last)))
+    return f.getvalue().encode()
+
+
+def build_mapping_export(request):
+    f = io.StringIO()
+    synthetic.write_mapping(f, request["mapping_type"], scale)
+    return f.getvalue().encode()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *a):
+        pass
+
+    def reply(self, status, body=b"", headers=()):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+
+        if self.path.endswith("/user/login"):
+            return self.reply(200, json.dumps({"token": TOKEN}).encode())
+
+        if self.headers.get("authorization") != "Token " + TOKEN:
+            return self.reply(401, b'{"message": "Invalid token"}')
+
+        if self.path.endswith("/data_export"):
+            body = build_data_export(request)
+        elif self.path.endswith("/mapping_export"):
+            body = build_mapping_export(request)
+        else:
+            return self.reply(404, b'{"message": "Not found"}')
+
+        with exports_lock:
+            export_id = str(next(export_ids))
+            exports[export_id] = (time.time() + args.delay, body)
+
+        url = "http://{}:{}/exports/{}".format(
+            self.server.server_address[0], self.server.server_address[1], export_id
+        )
+        self.reply(200, json.dumps({"url": url}).encode())
+
+    def do_GET(self):
+        ready, body = exports.get(self.path.rsplit("/", 1)[-1], (None, None))
+        if body is None or time.time() < ready:
+            return self.reply(404, b"")
+
+        etag = '"{}"'.format(hash(body))
+        if self.headers.get("if-none-match") == etag:
+            return self.reply(304, headers=[("ETag", etag)])
+
+        byte_range = self.headers.get("range")
+        if byte_range:
+            start = int(byte_range.split("=")[1].rstrip("-"))
+            if start >= len(body):
+                return self.reply(
+                    416, headers=[("Content-Range", "bytes */{}".format(len(body)))]
+                )
+
+            return self.reply(
+                206,
+                body[start:],
+                headers=[
+                    (
+                        "Content-Range",
+                        "bytes {}-{}/{}".format(start, len(body) - 1, len(body)),
+                    )
+                ],
+            )
+
+        self.reply(200, body, headers=[("ETag", etag)])
+
+    def do_HEAD(self):
+        self.do_GET()
+
+
+if __name__ == "__main__":
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), Handler)
+    print("Serving synthetic CREDO API at http://127.0.0.1:{}".format(args.port))
+    server.serve_forever()
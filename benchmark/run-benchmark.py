@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import synthetic
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+EXPORTER = REPO_DIR + "/data-exporter/credo-data-exporter.py"
+PROCESSOR = REPO_DIR + "/data-processor/credo-data-processor.py"
+
+parser = argparse.ArgumentParser(
+    description="Benchmark the CREDO exporter and processor on synthetic data"
+)
+
+parser.add_argument(
+    "--work-dir", help="Directory for data and logs (default: temporary)"
+)
+parser.add_argument(
+    "--skip-export",
+    action="store_true",
+    help="Generate export files directly instead of exporting them from the "
+    "mock API",
+)
+parser.add_argument(
+    "--delay",
+    type=float,
+    default=1,
+    help="Seconds before an export requested from the mock API is available",
+)
+parser.add_argument(
+    "--exporter-args",
+    default="--max-chunk-size 10000",
+    help="Extra arguments for the exporter",
+)
+parser.add_argument(
+    "--processor-args", default="", help="Extra arguments for the processor"
+)
+parser.add_argument(
+    "--plugin-dir",
+    default=REPO_DIR + "/data-processor/plugins",
+    help="Directory containing plugins",
+)
+parser.add_argument(
+    "--plugins",
+    default="count_batch,count_per_user",
+    help="Comma separated plugins to benchmark, together and one by one",
+)
+parser.add_argument("--json", help="Write results to this file as JSON")
+synthetic.add_scale_arguments(parser)
+
+args = parser.parse_args()
+
+scale = synthetic.scale_from_args(args)
+
+
+def scale_arguments():
+    return [
+        "--detections",
+        str(scale.detections),
+        "--pings",
+        str(scale.pings),
+        "--users",
+        str(scale.users),
+        "--devices",
+        str(scale.devices),
+        "--teams",
+        str(scale.teams),
+        "--frame-size",
+        str(scale.frame_size),
+        "--seed",
+        str(scale.seed),
+    ]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+
+    raise RuntimeError("Mock API did not start")
+
+
+def measure(name, command, log_path):
+    # Runs the command to completion, returning its wall time and peak RSS
+    print("Running {}".format(name))
+
+    with open(log_path, "w") as log:
+        started = time.perf_counter()
+        p = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(p.pid, 0)
+        wall = time.perf_counter() - started
+
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError("{} failed, see {}".format(name, log_path))
+
+    return {
+        "name": name,
+        "wall": wall,
+        "cpu": usage.ru_utime + usage.ru_stime,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss": usage.ru_maxrss * 1024,
+    }
+
+
+def export_size(data_dir):
+    size = 0
+    for data_type in ["detection", "ping"]:
+        for entry in os.scandir("{}/{}s".format(data_dir, data_type)):
+            size += entry.stat().st_size
+    return size
+
+
+def linked_copy(src, dst):
+    # Every processor run starts from the same exports, without a ledger or
+    # plugin state, and hard links keep copying cheap
+    shutil.copytree(src, dst, copy_function=os.link)
+    for entry in os.scandir(dst):
+        if entry.is_file() and not entry.name.endswith("_mapping.json"):
+            os.remove(entry.path)
+
+
+def plugin_dir(work_dir, plugins):
+    path = tempfile.mkdtemp(prefix="plugins-", dir=work_dir)
+    for plugin in plugins:
+        os.symlink(
+            os.path.abspath("{}/{}.py".format(args.plugin_dir, plugin)),
+            "{}/{}.py".format(path, plugin),
+        )
+    return path
+
+
+def export(work_dir, data_dir):
+    if args.skip_export:
+        result = measure(
+            "generate",
+            [sys.executable, BENCHMARK_DIR + "/generate-data.py", "--dir", data_dir]
+            + scale_arguments(),
+            work_dir + "/generate.log",
+        )
+    else:
+        port = free_port()
+        api = subprocess.Popen(
+            [
+                sys.executable,
+                BENCHMARK_DIR + "/mock-api.py",
+                "--port",
+                str(port),
+                "--delay",
+                str(args.delay),
+            ]
+            + scale_arguments(),
+            stdout=subprocess.DEVNULL,
+        )
+
+        try:
+            wait_for_port(port)
+            result = measure(
+                "export",
+                [
+                    sys.executable,
+                    EXPORTER,
+                    "--endpoint",
+                    "http://127.0.0.1:{}".format(port),
+                    "--username",
+                    "benchmark",
+                    "--password",
+                    "benchmark",
+                    "--dir",
+                    data_dir,
+                    "--mapping-type",
+                    "all",
+                ]
+                + shlex.split(args.exporter_args),
+                work_dir + "/export.log",
+            )
+        finally:
+            api.terminate()
+            api.wait()
+
+    result["events"] = scale.detections + scale.pings
+    result["bytes"] = export_size(data_dir)
+    return result
+
+
+def process(work_dir, data_dir, name, plugins):
+    run_dir = "{}/{}".format(work_dir, name.replace(" ", "-"))
+    linked_copy(data_dir, run_dir)
+
+    result = measure(
+        name,
+        [
+            sys.executable,
+            PROCESSOR,
+            "--dir",
+            run_dir,
+            "--plugin-dir",
+            plugin_dir(work_dir, plugins),
+        ]
+        + shlex.split(args.processor_args),
+        run_dir + ".log",
+    )
+    result["events"] = scale.detections + scale.pings
+    result["bytes"] = export_size(data_dir)
+
+    shutil.rmtree(run_dir)
+    return result
+
+
+def print_results(results):
+    print(
+        "{:<32} {:>9} {:>9} {:>11} {:>8} {:>9}".format(
+            "step", "wall [s]", "cpu [s]", "events/s", "MB/s", "RSS [MB]"
+        )
+    )
+    for r in results:
+        print(
+            "{:<32} {:>9.2f} {:>9.2f} {:>11.0f} {:>8.1f} {:>9.1f}".format(
+                r["name"],
+                r["wall"],
+                r["cpu"],
+                r["events"] / r["wall"],
+                r["bytes"] / r["wall"] / 1e6,
+                r["peak_rss"] / 1e6,
+            )
+        )
+
+
+def main():
+    work_dir = os.path.abspath(args.work_dir or tempfile.mkdtemp(prefix="credo-"))
+    os.makedirs(work_dir, exist_ok=True)
+    data_dir = work_dir + "/data"
+
+    if os.path.exists(data_dir):
+        shutil.rmtree(data_dir)
+
+    plugins = [p for p in args.plugins.split(",") if p]
+
+    results = [export(work_dir, data_dir)]
+    results.append(process(work_dir, data_dir, "process", plugins))
+    if len(plugins) > 1:
+        for plugin in plugins:
+            results.append(process(work_dir, data_dir, "process " + plugin, [plugin]))
+
+    print_results(results)
+    print("Logs are in {}".format(work_dir))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {"scale": vars(scale), "args": vars(args), "results": results},
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
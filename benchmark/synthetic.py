@@ -0,0 +1,182 @@
+import base64
+import json
+import random
+
+# Synthetic events are a pure function of their index, so the mock API and
+# the file generator produce identical data without holding it in memory.
+# Event i is received at START_TIME + i * interval milliseconds.
+
+START_TIME = 1577836800000
+
+DEVICE_MODELS = ["SM-G960F", "Pixel 3", "Redmi Note 8", "ONEPLUS A6003", "Mi A2"]
+
+
+class Scale(object):
+    def __init__(
+        self,
+        detections=100000,
+        pings=100000,
+        users=1000,
+        devices=2000,
+        teams=50,
+        frame_size=1500,
+        detection_interval=50,
+        ping_interval=50,
+        seed=1,
+    ):
+        self.detections = detections
+        self.pings = pings
+        self.users = users
+        self.devices = devices
+        self.teams = teams
+        self.frame_size = frame_size
+        self.detection_interval = detection_interval
+        self.ping_interval = ping_interval
+        self.seed = seed
+
+    def count(self, data_type):
+        return self.detections if data_type == "detection" else self.pings
+
+    def interval(self, data_type):
+        if data_type == "detection":
+            return self.detection_interval
+        return self.ping_interval
+
+
+def add_scale_arguments(parser):
+    defaults = Scale()
+    parser.add_argument(
+        "--detections", type=int, default=defaults.detections, help="Detections"
+    )
+    parser.add_argument("--pings", type=int, default=defaults.pings, help="Pings")
+    parser.add_argument("--users", type=int, default=defaults.users, help="Users")
+    parser.add_argument("--devices", type=int, default=defaults.devices, help="Devices")
+    parser.add_argument("--teams", type=int, default=defaults.teams, help="Teams")
+    parser.add_argument(
+        "--frame-size",
+        type=int,
+        default=defaults.frame_size,
+        help="Size of detection frames in bytes, before base64",
+    )
+    parser.add_argument("--seed", type=int, default=defaults.seed, help="Random seed")
+
+
+def scale_from_args(args):
+    return Scale(
+        detections=args.detections,
+        pings=args.pings,
+        users=args.users,
+        devices=args.devices,
+        teams=args.teams,
+        frame_size=args.frame_size,
+        seed=args.seed,
+    )
+
+
+def time_received(scale, data_type, i):
+    return START_TIME + i * scale.interval(data_type)
+
+
+def index_range(scale, data_type, since, until):
+    # Indices of events received strictly between since and until
+    interval = scale.interval(data_type)
+    first = max(0, (since - START_TIME) // interval + 1)
+    last = min(scale.count(data_type), -(-(until - START_TIME) // interval))
+    return first, max(first, last)
+
+
+def device_of(scale, rnd):
+    device_id = rnd.randrange(scale.devices) + 1
+    # Devices belong to users in a fixed way, as in the real mapping
+    return device_id, device_id % scale.users + 1
+
+
+def detection(scale, i):
+    rnd = random.Random(scale.seed * 1000003 + i)
+    received = time_received(scale, "detection", i)
+    device_id, user_id = device_of(scale, rnd)
+    located = rnd.random() < 0.7
+
+    return {
+        "id": i + 1,
+        "user_id": user_id,
+        "device_id": device_id,
+        "team_id": user_id % scale.teams + 1 if rnd.random() < 0.5 else None,
+        "timestamp": received - rnd.randint(0, 60000),
+        "time_received": received,
+        "x": rnd.randint(0, 4000),
+        "y": rnd.randint(0, 3000),
+        "width": 60,
+        "height": 60,
+        "latitude": rnd.uniform(-60, 70) if located else None,
+        "longitude": rnd.uniform(-180, 180) if located else None,
+        "altitude": rnd.uniform(0, 500) if located else None,
+        "accuracy": rnd.uniform(1, 50) if located else None,
+        "provider": "gps" if located else None,
+        "source": "manual_reading",
+        "visible": rnd.random() < 0.9,
+        "frame_content": base64.b64encode(
+            rnd.getrandbits(8 * scale.frame_size).to_bytes(scale.frame_size, "little")
+        ).decode("ascii"),
+    }
+
+
+def ping(scale, i):
+    rnd = random.Random(scale.seed * 1000033 + i)
+    received = time_received(scale, "ping", i)
+    device_id, user_id = device_of(scale, rnd)
+
+    return {
+        "id": i + 1,
+        "user_id": user_id,
+        "device_id": device_id,
+        "timestamp": received - rnd.randint(0, 60000),
+        "time_received": received,
+        "on_time": rnd.randint(0, 600000),
+        "delta_time": rnd.randint(0, 600000),
+    }
+
+
+EVENTS = {"detection": detection, "ping": ping}
+
+
+def users(scale):
+    for i in range(1, scale.users + 1):
+        yield {
+            "id": i,
+            "username": "user{}".format(i),
+            "display_name": "User {}".format(i),
+        }
+
+
+def devices(scale):
+    for i in range(1, scale.devices + 1):
+        yield {
+            "id": i,
+            "device_model": DEVICE_MODELS[i % len(DEVICE_MODELS)],
+            "system_version": "{}.0".format(7 + i % 5),
+            "device_type": "phone_android",
+            "user_id": i % scale.users + 1,
+        }
+
+
+def teams(scale):
+    for i in range(1, scale.teams + 1):
+        yield {"id": i, "name": "team{}".format(i)}
+
+
+MAPPINGS = {"user": users, "device": devices, "team": teams}
+
+
+def write_export(f, data_type, events):
+    # Same layout as exports served by the API: one array named after the type
+    f.write('{{"{}s": ['.format(data_type))
+    for n, event in enumerate(events):
+        if n:
+            f.write(", ")
+        f.write(json.dumps(event))
+    f.write("]}")
+
+
+def write_mapping(f, mapping_type, scale):
+    write_export(f, mapping_type, MAPPINGS[mapping_type](scale))
@@ -2,13 +2,25 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import argparse
+import collections
 import errno
+import gzip
+import hashlib
+import io
+import json
 import os
 import platform
 import random
+import queue
+import sqlite3
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
+
+import credo_common
 
 parser = argparse.ArgumentParser(
     description="Tool for incremental data export from CREDO"
@@ -46,15 +58,251 @@ parser.add_argument(
     help="Type of mapping to update (device/user/all/none)",
     default="none",
 )
+parser.add_argument(
+    "--jobs",
+    "-j",
+    help="Number of export requests to run concurrently",
+    type=int,
+    default=1,
+)
+parser.add_argument(
+    "--window",
+    "-w",
+    help="Split the exported time range into windows of this many hours and "
+    "export them concurrently (requires --jobs > 1)",
+    type=int,
+    default=0,
+)
+parser.add_argument(
+    "--poll-deadline",
+    help="Give up waiting for an export after this many seconds",
+    type=int,
+    default=3600,
+)
+parser.add_argument(
+    "--compress",
+    help="Compress exported files (none/gzip/zstd, zstd requires zstandard)",
+    choices=["none", "gzip", "zstd"],
+    default="none",
+)
+parser.add_argument(
+    "--metrics", help="Append timings of export stages to this file as JSON lines"
+)
+parser.add_argument(
+    "--prometheus",
+    help="Write totals of export stages to this file in Prometheus text format",
+)
+
+DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+READ_BLOCK_SIZE = 1024 * 1024
+
+COMPRESSED_SUFFIXES = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+TOKEN_LIFETIME = 3600 * 24
+
+MIN_POLL_DELAY = 2
+MAX_POLL_DELAY = 300
+TIMING_WEIGHT = 0.3
+
+# Fields of metric events summed into Prometheus counters, labelled by the
+# event's data_type or export
+METRIC_COUNTERS = {
+    "wait": ["seconds", "polls"],
+    "download": ["seconds", "write_seconds", "bytes"],
+    "commit": ["seconds", "events", "bytes"],
+}
+METRIC_LABELS = ["data_type", "export"]
+
+journal_lock = threading.RLock()
+token_lock = threading.Lock()
+timing_lock = threading.Lock()
+metrics_lock = threading.Lock()
+metrics_totals = collections.defaultdict(float)
+token = None
+
+# Set to stop waiting for and downloading exports, on Ctrl+C or when the data
+# processor's --watch mode is stopped
+stopping = threading.Event()
+
+args = None
+session = None
+
+
+def configure(argv=None):
+    # Parses arguments and opens the HTTP session. The data processor's
+    # --watch mode imports this module and calls this once, then main() on
+    # every cycle, keeping the session and token between exports.
+    global args, session
+
+    args = parser.parse_args(argv)
+    args.endpoint = args.endpoint.rstrip("/")
+    args.dir = args.dir.rstrip("/")
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=max(10, args.jobs * 2))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+
+def emit_metric(event, **fields):
+    if not args.metrics and not args.prometheus:
+        return
+
+    record = dict(time=time.time(), event=event, **fields)
+    labels = tuple((k, fields[k]) for k in METRIC_LABELS if k in fields)
+
+    with metrics_lock:
+        if args.metrics:
+            with open(args.metrics, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+        for field in METRIC_COUNTERS.get(event, []):
+            name = "credo_exporter_{}_{}_total".format(event, field)
+            metrics_totals[(name, labels)] += fields[field]
+
+
+def download(r, path, mode="wb"):
+    # Time spent writing is measured apart from the time spent receiving data
+    started = time.perf_counter()
+    write_seconds = 0
+    size = 0
+
+    with open(path, mode) as f:
+        for chunk in r.iter_content(DOWNLOAD_BLOCK_SIZE):
+            if stopping.is_set():
+                raise RuntimeError("Exporter stopped during download")
+
+            write_started = time.perf_counter()
+            f.write(chunk)
+            write_seconds += time.perf_counter() - write_started
+            size += len(chunk)
+
+    emit_metric(
+        "download",
+        file=os.path.basename(path),
+        bytes=size,
+        seconds=time.perf_counter() - started - write_seconds,
+        write_seconds=write_seconds,
+    )
+
+
+def open_export(path):
+    # Opens an export file for reading, decompressing it if needed
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+
+    if path.endswith(".zst"):
+        import zstandard
+
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+
+    return open(path, "rb")
+
 
-args = parser.parse_args()
+def compress_file(path, compressed_path):
+    tmp_path = compressed_path + ".tmp"
 
-args.endpoint = args.endpoint.rstrip("/")
-args.dir = args.dir.rstrip("/")
+    with open(path, "rb") as src, open(tmp_path, "wb") as f:
+        if args.compress == "gzip":
+            dst = gzip.GzipFile(fileobj=f, mode="wb", compresslevel=6)
+        else:
+            import zstandard
+
+            dst = zstandard.ZstdCompressor(level=10).stream_writer(f)
+
+        with dst:
+            for block in iter(lambda: src.read(READ_BLOCK_SIZE), b""):
+                dst.write(block)
+
+    os.replace(tmp_path, compressed_path)
+
+
+def file_checksum(path):
+    # Checksum of the exported data, also for compressed files
+    h = hashlib.sha256()
+
+    with open_export(path) as f:
+        for block in iter(lambda: f.read(READ_BLOCK_SIZE), b""):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+def journal_path():
+    return args.dir + "/export_journal.json"
+
+
+def load_journal():
+    if not os.path.exists(journal_path()):
+        return {}
+
+    with open(journal_path()) as f:
+        return json.load(f)
+
+
+def update_journal(key, entry):
+    with journal_lock:
+        journal = load_journal()
+
+        if entry is None:
+            journal.pop(key, None)
+        else:
+            journal[key] = entry
+
+        with open(journal_path() + ".tmp", "w") as f:
+            json.dump(journal, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(journal_path() + ".tmp", journal_path())
+
+
+def journal_key(data_type, time_since, time_until):
+    return "{}_{}_{}".format(data_type, time_since, time_until)
+
+
+def find_journal_entry(data_type, time_since, time_until):
+    # The entry of this exact range, or one requested by an earlier run for
+    # a range starting at the same time. Ranges exported concurrently never
+    # start at the same time, see export_window().
+    with journal_lock:
+        journal = load_journal()
 
+        entry = journal.get(journal_key(data_type, time_since, time_until))
+        if entry is not None:
+            return entry
 
-def random_sleep(seconds):
-    time.sleep(seconds + random.random() * seconds)
+        for entry in journal.values():
+            if entry["data_type"] == data_type and entry["since"] == time_since:
+                return entry
+
+        return None
+
+
+def part_path(data_type, time_since, time_until):
+    return "{}/{}_export_{}_{}.part".format(args.dir, data_type, time_since, time_until)
+
+
+def export_path(data_type, time_since, last_timestamp):
+    return "{}/{}s/export_{}_{}.json{}".format(
+        args.dir,
+        data_type,
+        time_since,
+        last_timestamp,
+        COMPRESSED_SUFFIXES[args.compress],
+    )
+
+
+def scan_export(path, data_type):
+    count = 0
+    last_timestamp = None
+
+    with io.open(path, encoding="utf-8") as f:
+        for event in credo_common.iter_array(f, data_type + "s"):
+            count += 1
+            last_timestamp = event["time_received"]
+
+    return count, last_timestamp
 
 
 def prepare_workspace():
@@ -71,6 +319,9 @@ def prepare_workspace():
     if not os.path.exists(args.dir + "/pings"):
         os.makedirs(args.dir + "/pings")
 
+    if not os.path.exists(args.dir + "/mapping_deltas"):
+        os.makedirs(args.dir + "/mapping_deltas")
+
     if not os.path.exists(args.dir + "/device_id"):
         with open(args.dir + "/device_id", "w+") as f:
             f.write(os.urandom(16).hex())
@@ -89,179 +340,681 @@ def get_base_request():
     }
 
 
+def load_token():
+    if not os.path.exists(args.dir + "/token"):
+        return None
+
+    # A damaged cache only costs a new login
+    try:
+        with open(args.dir + "/token") as f:
+            cached = json.load(f)
+    except ValueError:
+        return None
+
+    if cached["username"] != args.username or cached["expires"] < time.time():
+        return None
+
+    return cached["token"]
+
+
+def save_token(token):
+    path = args.dir + "/token"
+    fd = os.open(path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump(
+            {
+                "username": args.username,
+                "token": token,
+                "expires": time.time() + TOKEN_LIFETIME,
+            },
+            f,
+        )
+    os.replace(path + ".tmp", path)
+
+
 def get_token():
+    global token
+
     if args.token:
-        print("Using token provided by user")
         return args.token
 
-    j = get_base_request()
-    j["username"] = args.username
-    j["password"] = args.password
+    with token_lock:
+        if token is None:
+            token = load_token()
 
-    r = requests.post(args.endpoint + "/user/login", json=j)
+        if token is None:
+            j = get_base_request()
+            j["username"] = args.username
+            j["password"] = args.password
 
-    if not r.ok:
-        print(r.json())
-        r.raise_for_status()
+            r = session.post(args.endpoint + "/user/login", json=j)
 
-    return r.json()["token"]
+            if not r.ok:
+                print(r.json())
+                r.raise_for_status()
 
+            token = r.json()["token"]
+            save_token(token)
 
-def update_mapping(mapping_type):
-    j = get_base_request()
-    j["mapping_type"] = mapping_type
+        return token
+
+
+def invalidate_token(rejected):
+    global token
+
+    with token_lock:
+        if token == rejected:
+            token = None
 
-    r = requests.post(
-        args.endpoint + "/mapping_export",
-        json=j,
-        headers={"authorization": "Token " + get_token()},
+            if os.path.exists(args.dir + "/token"):
+                os.remove(args.dir + "/token")
+
+
+def request_export(path, j):
+    used_token = get_token()
+    r = session.post(
+        args.endpoint + path, json=j, headers={"authorization": "Token " + used_token}
     )
 
+    # Cached tokens may have been revoked on the server, log in again once.
+    if r.status_code == 401 and not args.token:
+        invalidate_token(used_token)
+        r = session.post(
+            args.endpoint + path,
+            json=j,
+            headers={"authorization": "Token " + get_token()},
+        )
+
     if not r.ok:
         print(r.json())
         r.raise_for_status()
 
-    export_url = r.json()["url"]
+    return r.json()["url"]
+
+
+def load_timings():
+    if not os.path.exists(args.dir + "/export_timing.json"):
+        return {}
+
+    with open(args.dir + "/export_timing.json") as f:
+        return json.load(f)
+
+
+def save_timings(timings):
+    # Replaced at once, as other threads read it without locking
+    with open(args.dir + "/export_timing.json.tmp", "w") as f:
+        json.dump(timings, f, indent=2, sort_keys=True)
+    os.replace(args.dir + "/export_timing.json.tmp", args.dir + "/export_timing.json")
+
+
+def record_timing(timing_key, seconds):
+    with timing_lock:
+        timings = load_timings()
+
+        if timing_key in timings:
+            seconds = (
+                TIMING_WEIGHT * seconds + (1 - TIMING_WEIGHT) * timings[timing_key]
+            )
+        timings[timing_key] = seconds
+
+        save_timings(timings)
+
+
+def chunk_timing_key(data_type, expected):
+    # Export times are learned per order of magnitude of the chunk size, so
+    # small incremental exports are not timed like full backfill chunks
+    size = 1
+    while size < expected:
+        size *= 10
+
+    return "{}_{}".format(data_type, size)
+
+
+def expected_chunk_size(data_type):
+    # The size of the last chunk, which is what a regular incremental export
+    # gets again
+    return load_timings().get(data_type + "_last_count", args.max_chunk_size)
 
-    print("Exported mapping will appear at {}".format(export_url))
 
-    random_sleep(30)
+def record_chunk_size(data_type, count):
+    with timing_lock:
+        timings = load_timings()
+        timings[data_type + "_last_count"] = count
+        save_timings(timings)
 
+
+def is_export_ready(export_url):
+    r = session.head(export_url)
+
+    # Fall back to GET if HEAD is not allowed on the export storage.
+    if r.status_code in (405, 501):
+        r = session.get(export_url, stream=True)
+        r.close()
+
+    return r.status_code != 404
+
+
+def pause(cancelled, seconds):
+    # Sleeps for the given time, returning True early once the export is
+    # cancelled or the exporter is stopping
+    deadline = time.time() + seconds
+    while not cancelled.is_set() and not stopping.is_set():
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        cancelled.wait(min(remaining, 1))
+
+    return True
+
+
+def wait_for_export(
+    export_url,
+    name,
+    requested,
+    timing_key,
+    cancelled=None,
+    offset=0,
+    headers=None,
+    learn=True,
+):
+    # The first check is scheduled a bit before the export is expected to be
+    # ready based on previous runs, afterwards the delay grows exponentially
+    # with jitter until the deadline passes. Only exports requested by this
+    # run are timed (learn), as resumed ones may have been ready long ago.
+    if cancelled is None:
+        cancelled = threading.Event()
+
+    estimate = load_timings().get(timing_key)
+    delay = MIN_POLL_DELAY
     retries = 0
+    pending = 0
+
+    if estimate is not None:
+        pending = requested + min(estimate * 0.75, args.poll_deadline) - time.time()
 
     while True:
-        r = requests.get(export_url)
+        if pause(cancelled, pending):
+            return None
+
+        if is_export_ready(export_url):
+            if learn:
+                record_timing(
+                    timing_key, min(time.time() - requested, args.poll_deadline)
+                )
+            emit_metric(
+                "wait",
+                export=timing_key,
+                seconds=time.time() - requested,
+                polls=retries + 1,
+            )
+            break
 
-        if r.status_code == 404:
-            print("Waiting for mapping export to finish (retries: {})".format(retries))
-            retries += 1
+        if time.time() - requested > args.poll_deadline:
+            print("Exiting because data was not ready in time. Try again later.")
+            return None
 
-            if retries in range(10):
-                random_sleep(30)
-            elif retries in range(10, 15):
-                random_sleep(300)
-            else:
-                print("Exiting because data was not ready in time. Try again later.")
+        print("Waiting for {} export to finish (retries: {})".format(name, retries))
+        retries += 1
+
+        pending = delay * (0.5 + random.random())
+        delay = min(delay * 2, MAX_POLL_DELAY)
+
+    headers = dict(headers or {})
+    if offset:
+        headers["range"] = "bytes={}-".format(offset)
+    r = session.get(export_url, headers=headers, stream=True)
+
+    if not r.ok and r.status_code != 416:
+        print(r)
+        r.raise_for_status()
+
+    return r
+
+
+def fetch_export(r, path, offset):
+    with r:
+        if r.status_code == 206:
+            download(r, path, "ab")
+        elif r.status_code == 416:
+            # The partial download may already hold the whole export, anything
+            # else means it is corrupted and has to be downloaded again.
+            if r.headers.get("content-range") != "bytes */{}".format(offset):
+                os.remove(path)
+                r.raise_for_status()
+        else:
+            download(r, path)
+
+
+def open_mapping_index(mapping_type):
+    # Digests of the entries of the last downloaded mapping, used to find out
+    # which of them changed, plus validators of the download itself
+    db = sqlite3.connect("{}/{}_mapping.sqlite".format(args.dir, mapping_type))
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS entries ("
+        "  id INTEGER PRIMARY KEY,"
+        "  digest BLOB NOT NULL,"
+        "  run INTEGER NOT NULL"
+        ")"
+    )
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS download ("
+        "  id INTEGER PRIMARY KEY CHECK (id = 0),"
+        "  etag TEXT,"
+        "  last_modified TEXT,"
+        "  sha256 TEXT"
+        ")"
+    )
+    return db
+
+
+def diff_mapping(db, mapping_type, path, run):
+    # Writes entries which are new or changed since the previous mapping, and
+    # ids which disappeared from it, to a delta file in the format of the
+    # mapping export plus a "removed" list.
+    key = mapping_type + "s"
+    initial = db.execute("SELECT 1 FROM entries LIMIT 1").fetchone() is None
+    delta_path = "{}/mapping_deltas/{}_{}.json".format(args.dir, mapping_type, run)
+    changed = 0
+
+    with open(path) as f, open(delta_path + ".tmp", "w") as out:
+        out.write('{{"{}": ['.format(key))
+
+        for entry in credo_common.iter_array(f, key):
+            digest = credo_common.entry_digest(entry)
+            row = db.execute(
+                "SELECT digest FROM entries WHERE id = ?", (entry["id"],)
+            ).fetchone()
+            db.execute(
+                "INSERT OR REPLACE INTO entries (id, digest, run) VALUES (?, ?, ?)",
+                (entry["id"], digest, run),
+            )
+
+            if row is not None and row[0] == digest:
+                continue
+
+            if changed:
+                out.write(", ")
+            out.write(json.dumps(entry))
+            changed += 1
+
+        removed = [
+            row[0]
+            for row in db.execute("SELECT id FROM entries WHERE run != ?", (run,))
+        ]
+        db.execute("DELETE FROM entries WHERE run != ?", (run,))
+
+        out.write('], "removed": {}}}'.format(json.dumps(removed)))
+
+    # Without a previous mapping the delta would just repeat the whole file
+    if initial or not (changed or removed):
+        os.remove(delta_path + ".tmp")
+        return
+
+    os.replace(delta_path + ".tmp", delta_path)
+    print(
+        "{} mapping: {} entries added or changed, {} removed, delta saved to {}".format(
+            mapping_type, changed, len(removed), delta_path
+        )
+    )
+
+
+def update_mapping(mapping_type):
+    path = "{}/{}_mapping.json".format(args.dir, mapping_type)
+    db = open_mapping_index(mapping_type)
+
+    try:
+        etag, last_modified, checksum = db.execute(
+            "SELECT etag, last_modified, sha256 FROM download"
+        ).fetchone() or (None, None, None)
+
+        headers = {}
+        if os.path.exists(path):
+            if etag:
+                headers["if-none-match"] = etag
+            if last_modified:
+                headers["if-modified-since"] = last_modified
+
+        j = get_base_request()
+        j["mapping_type"] = mapping_type
+
+        requested = time.time()
+        export_url = request_export("/mapping_export", j)
+
+        print("Exported mapping will appear at {}".format(export_url))
+
+        r = wait_for_export(
+            export_url,
+            mapping_type + " mapping",
+            requested,
+            mapping_type + "_mapping",
+            headers=headers,
+        )
+        if r is None:
+            return
+
+        with r:
+            if r.status_code == 304:
+                print("{} mapping has not changed".format(mapping_type))
                 return
+            download(r, path + ".part")
 
+        new_checksum = file_checksum(path + ".part")
+        if new_checksum != checksum or not os.path.exists(path):
+            diff_mapping(db, mapping_type, path + ".part", int(requested * 1000))
+            os.replace(path + ".part", path)
         else:
-            if not r.ok:
-                print(r)
-                r.raise_for_status()
+            print("{} mapping has not changed".format(mapping_type))
+            os.remove(path + ".part")
+
+        db.execute(
+            "INSERT OR REPLACE INTO download (id, etag, last_modified, sha256) "
+            "VALUES (0, ?, ?, ?)",
+            (r.headers.get("etag"), r.headers.get("last-modified"), new_checksum),
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def split_range(time_since, time_until, window):
+    # Consecutive windows overlap by a millisecond, so events received exactly
+    # on a boundary are exported whichever way the server treats the bounds.
+    while time_until - time_since > window:
+        yield time_since, time_since + window + 1
+        time_since += window
+
+    yield time_since, time_until
+
+
+def verify_chunk(entry):
+    path = part_path(entry["data_type"], entry["since"], entry["until"])
+    if not os.path.exists(path):
+        path = export_path(entry["data_type"], entry["since"], entry["last_timestamp"])
+
+    return os.path.exists(path) and file_checksum(path) == entry["sha256"]
+
+
+def export_window(data_type, time_since, time_until, chunks, cancelled):
+    # Downloads consecutive chunks of a single time window and hands them to
+    # the committing thread through the chunks queue. The queue is closed
+    # with True when the window was exported completely, False otherwise.
+    # Every step is recorded in the export journal, so an interrupted run
+    # picks up the already requested export instead of requesting it again.
+    expected = expected_chunk_size(data_type)
+
+    try:
+        while not cancelled.is_set() and not stopping.is_set():
+            entry = find_journal_entry(data_type, time_since, time_until)
+            requested_here = False
+
+            if entry is not None and entry["until"] > time_until:
+                # Requested for a wider window than this run uses, resuming it
+                # would overlap with the next window.
+                discard_entry(entry)
+                entry = None
+
+            if entry is not None:
+                key = journal_key(data_type, entry["since"], entry["until"])
+                path = part_path(data_type, entry["since"], entry["until"])
+            else:
+                key = journal_key(data_type, time_since, time_until)
+                path = part_path(data_type, time_since, time_until)
+
+            if entry is not None and "sha256" in entry and not verify_chunk(entry):
+                print("Discarding corrupted download of {}".format(entry["url"]))
+                if os.path.exists(path):
+                    os.remove(path)
+                entry = {
+                    k: entry[k]
+                    for k in ("data_type", "since", "until", "requested", "url")
+                    if k in entry
+                }
+
+            if entry is None:
+                j = get_base_request()
+
+                j["since"] = time_since
+                j["until"] = time_until
+                j["limit"] = args.max_chunk_size
+                j["data_type"] = data_type
+
+                entry = {
+                    "data_type": data_type,
+                    "since": time_since,
+                    "until": time_until,
+                    "requested": time.time(),
+                    "url": request_export("/data_export", j),
+                }
+                update_journal(key, entry)
+                requested_here = True
+
+                print("Exported data will appear at {}".format(entry["url"]))
+            else:
+                print("Resuming export from {}".format(entry["url"]))
+
+            if "sha256" not in entry:
+                offset = os.path.getsize(path) if os.path.exists(path) else 0
+
+                r = wait_for_export(
+                    entry["url"],
+                    data_type,
+                    entry.get("requested", time.time()),
+                    chunk_timing_key(data_type, expected),
+                    cancelled,
+                    offset,
+                    learn=requested_here,
+                )
+                if r is None:
+                    if not cancelled.is_set() and not stopping.is_set():
+                        # The export may have expired on the server, so ask
+                        # for a fresh one next time.
+                        update_journal(key, None)
+                    chunks.put(False)
+                    return
+
+                fetch_export(r, path, offset)
+
+                entry["count"], entry["last_timestamp"] = scan_export(path, data_type)
+                entry["bytes"] = os.path.getsize(path)
+                entry["sha256"] = file_checksum(path)
+                update_journal(key, entry)
+
+                expected = entry["count"]
+                record_chunk_size(data_type, expected)
+
+            if entry["count"]:
+                chunks.put(entry)
+                time_since = entry["last_timestamp"]
+            else:
+                os.remove(path)
+                update_journal(key, None)
 
-            break
+            if entry["count"] < args.max_chunk_size and entry["until"] >= time_until:
+                break
+
+            # The rest belongs to the next window, which starts a millisecond
+            # before this one ends. Going on would request a range starting
+            # at the same time as the next window's.
+            if entry["count"] and entry["last_timestamp"] >= time_until - 1:
+                break
+
+            print("There is more data to download, updating again.")
+
+        chunks.put(not cancelled.is_set() and not stopping.is_set())
+    except BaseException as e:
+        chunks.put(e)
+
+
+def commit_chunk(entry):
+    data_type = entry["data_type"]
+    path = part_path(data_type, entry["since"], entry["until"])
+    final_path = export_path(data_type, entry["since"], entry["last_timestamp"])
+    started = time.perf_counter()
+
+    # The file is already in place when a run was interrupted right after
+    # moving it. Without either, moving last_exported_<type> on would skip
+    # the chunk's events.
+    if not os.path.exists(path) and not os.path.exists(final_path):
+        raise RuntimeError("Missing export file for {}".format(path))
+
+    if os.path.exists(path):
+        if args.compress == "none":
+            os.replace(path, final_path)
+        else:
+            compress_file(path, final_path)
+            os.remove(path)
+
+    # The cursor replaces the old one in a single step and is on disk before
+    # the journal entry, the only other record of the chunk, is dropped
+    cursor_path = args.dir + "/last_exported_" + data_type
+    with open(cursor_path + ".tmp", "w") as f:
+        f.write(str(entry["last_timestamp"]))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(cursor_path + ".tmp", cursor_path)
+
+    update_journal(journal_key(data_type, entry["since"], entry["until"]), None)
+
+    emit_metric(
+        "commit",
+        data_type=data_type,
+        events=entry["count"],
+        bytes=entry["bytes"],
+        seconds=time.perf_counter() - started,
+    )
+
+
+def discard_entry(entry, key=None):
+    path = part_path(entry["data_type"], entry["since"], entry["until"])
+    if os.path.exists(path):
+        os.remove(path)
+
+    if key is None:
+        key = journal_key(entry["data_type"], entry["since"], entry["until"])
+    update_journal(key, None)
 
-    with open("{}/{}_mapping.json".format(args.dir, mapping_type), "wb") as f:
-        for chunk in r.iter_content(4096):
-            f.write(chunk)
+
+def discard_journal(data_type, keep=lambda entry: False):
+    for key, entry in load_journal().items():
+        if entry["data_type"] == data_type and not keep(entry):
+            discard_entry(entry, key)
 
 
 def update_data(data_type):
-    repeat = False
     time_since = 0
 
     if os.path.exists(args.dir + "/last_exported_" + data_type):
         with open(args.dir + "/last_exported_" + data_type) as f:
             time_since = int(f.readline())
 
-    j = get_base_request()
+    # Entries older than the last committed chunk can never be resumed.
+    discard_journal(data_type, keep=lambda entry: entry["since"] >= time_since)
 
-    j["since"] = time_since
-    j["until"] = int((time.time() + 3600 * 24) * 1000)
-    j["limit"] = args.max_chunk_size
-    j["data_type"] = data_type
+    time_until = int((time.time() + 3600 * 24) * 1000)
 
-    r = requests.post(
-        args.endpoint + "/data_export",
-        json=j,
-        headers={"authorization": "Token " + get_token()},
-    )
+    # Without a previous export there is no telling where the data starts, so
+    # the first run is never split into windows.
+    if args.window and args.jobs > 1 and time_since:
+        windows = split_range(time_since, time_until, args.window * 3600 * 1000)
+    else:
+        windows = iter([(time_since, time_until)])
 
-    if not r.ok:
-        print(r.json())
-        r.raise_for_status()
+    pending = collections.deque()
+    cancelled = threading.Event()
+    committed = 0
+    complete = True
 
-    export_url = r.json()["url"]
+    # Windows are exported concurrently, but chunks are committed strictly in
+    # time order so that last_exported_<type> never skips over missing data.
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
 
-    print("Exported data will appear at {}".format(export_url))
+        def submit_windows():
+            while len(pending) < args.jobs:
+                window = next(windows, None)
+                if window is None:
+                    return
+                chunks = queue.Queue()
+                executor.submit(export_window, data_type, *window, chunks, cancelled)
+                pending.append(chunks)
 
-    random_sleep(30)
+        try:
+            submit_windows()
 
-    retries = 0
+            while pending:
+                chunks = pending.popleft()
+                submit_windows()
 
-    while True:
-        r = requests.get(export_url)
+                chunk = chunks.get()
+                while isinstance(chunk, dict):
+                    commit_chunk(chunk)
+                    committed += 1
+                    chunk = chunks.get()
 
-        if r.status_code == 404:
-            print("Waiting for mapping export to finish (retries: {})".format(retries))
-            retries += 1
+                if isinstance(chunk, BaseException):
+                    raise chunk
+                if not chunk:
+                    complete = False
+                    break
+        finally:
+            cancelled.set()
 
-            if retries in range(10):
-                random_sleep(30)
-            elif retries in range(10, 15):
-                random_sleep(300)
-            else:
-                print("Exiting because data was not ready in time. Try again later.")
-                return
+    # Leftovers of windows which did not line up with this run's windows.
+    if complete:
+        discard_journal(data_type)
 
-        else:
-            if not r.ok:
-                print(r)
-                r.raise_for_status()
-
-            events = r.json()[data_type + "s"]
-            if len(events) == args.max_chunk_size:
-                repeat = True
-
-            if events:
-                last_timestamp = events[-1]["time_received"]
-                del events
-
-                with open(
-                        "{}/{}s/export_{}_{}.json".format(
-                            args.dir, data_type, time_since, last_timestamp
-                        ),
-                        "wb",
-                ) as f:
-                    for chunk in r.iter_content(4096):
-                        f.write(chunk)
-
-                with open(args.dir + "/last_exported_" + data_type, "w+") as f:
-                    f.write(str(last_timestamp))
-            else:
-                print("No new events")
+    if not committed:
+        print("No new events")
 
-            break
-
-    if repeat:
-        del r
 
-        print("There is more data to download, updating again.")
-        update_data(data_type)
+def main():
+    if args.token:
+        print("Using token provided by user")
 
+    tasks = []
 
-def main():
     if args.mapping_type in ["user", "all"]:
-        print("Updating user mapping")
-        update_mapping("user")
+        tasks.append(("Updating user mapping", update_mapping, "user"))
 
     if args.mapping_type in ["device", "all"]:
-        print("Updating device mapping")
-        update_mapping("device")
+        tasks.append(("Updating device mapping", update_mapping, "device"))
 
     if args.mapping_type in ["team", "all"]:
-        print("Updating team mapping")
-        update_mapping("team")
+        tasks.append(("Updating team mapping", update_mapping, "team"))
 
     if args.data_type in ["detection", "all"]:
-        print("Updating detections")
-        update_data("detection")
+        tasks.append(("Updating detections", update_data, "detection"))
 
     if args.data_type in ["ping", "all"]:
-        print("Updating pings")
-        update_data("ping")
+        tasks.append(("Updating pings", update_data, "ping"))
+
+    def run(task):
+        message, update, name = task
+        print(message)
+        update(name)
+
+    started = time.perf_counter()
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            futures = [executor.submit(run, task) for task in tasks]
+            try:
+                for future in futures:
+                    future.result()
+            except KeyboardInterrupt:
+                # Running tasks return once they notice, tasks which have
+                # not started yet are dropped
+                stopping.set()
+                executor.shutdown(cancel_futures=True)
+                raise
+    finally:
+        emit_metric("run", seconds=time.perf_counter() - started)
+
+        if args.prometheus:
+            with metrics_lock:
+                credo_common.write_prometheus(args.prometheus, metrics_totals)
 
 
 if __name__ == "__main__":
+    configure()
     prepare_workspace()
     main()
@@ -0,0 +1,93 @@
+# Helpers for the files written by the exporter, also used by
+# miscellaneous/mapping-export-to-elasticsearch.py. The data processor keeps
+# its own copies (credo_json.py, credo_metrics.py) so that each tool can be
+# deployed on its own.
+import hashlib
+import json
+import os
+import re
+
+READ_BLOCK_SIZE = 1024 * 1024
+
+SEPARATORS = re.compile(r"[\s,]*")
+
+WHITESPACE = re.compile(r"\s*")
+
+
+def iter_array(f, key):
+    # Yields elements of the "key" array one at a time, so only a single
+    # element (plus one read block) is held in memory no matter how large the
+    # file is. Export files and mapping files are both read this way.
+    decoder = json.JSONDecoder()
+    array_start = re.compile(r'"{}"\s*:\s*\['.format(re.escape(key)))
+    buf = ""
+    pos = None
+
+    while True:
+        block = f.read(READ_BLOCK_SIZE)
+        buf += block
+
+        if pos is None:
+            match = array_start.search(buf)
+            if match is None:
+                if not block:
+                    return
+                continue
+            pos = match.end()
+
+        while True:
+            pos = SEPARATORS.match(buf, pos).end()
+            if pos == len(buf):
+                break
+            if buf[pos] == "]":
+                return
+            try:
+                element, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                break
+
+            # A number cut off at the end of the block also decodes (as a
+            # shorter one), so an element is only taken once the separator
+            # or the end of the array follows it
+            after = WHITESPACE.match(buf, end).end()
+            if block and (after == len(buf) or buf[after] not in ",]"):
+                break
+
+            pos = end
+            yield element
+
+        if not block:
+            raise ValueError("Unexpected end of {} data".format(key))
+
+        buf = buf[pos:]
+        pos = 0
+
+
+def entry_digest(entry):
+    # Digest of a mapping entry, independent of the order of its fields
+    return hashlib.sha1(
+        json.dumps(entry, sort_keys=True, separators=(",", ":")).encode()
+    ).digest()
+
+
+def write_prometheus(path, totals):
+    # Writes counters keyed by (name, labels) as a Prometheus textfile
+    lines = []
+    for name in sorted(set(name for name, _ in totals)):
+        lines.append("# TYPE {} counter".format(name))
+        for (metric, labels), value in sorted(totals.items()):
+            if metric != name:
+                continue
+
+            if labels:
+                name_labels = "{}{{{}}}".format(
+                    name, ",".join('{}="{}"'.format(k, v) for k, v in labels)
+                )
+            else:
+                name_labels = name
+            lines.append("{} {}".format(name_labels, value))
+
+    # Textfile collectors may read the file at any time
+    with open(path + ".tmp", "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(path + ".tmp", path)
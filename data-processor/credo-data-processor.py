@@ -1,9 +1,24 @@
 #!/usr/bin/env python3
 import argparse
 import errno
+import gzip
 import importlib.util
-import json
+import io
+import multiprocessing
 import os
+import queue
+import re
+import shlex
+import signal
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import credo_json
+import credo_mappings
+import credo_metrics
+import credo_seen
 
 parser = argparse.ArgumentParser(
     description="Tool for incremental processing of CREDO data"
@@ -24,12 +39,108 @@ parser.add_argument(
     default="all",
 )
 parser.add_argument("--delete", action="store_true", help="Delete processed files")
+parser.add_argument(
+    "--jobs",
+    "-j",
+    help="Number of worker processes used to read export files",
+    type=int,
+    default=1,
+)
+parser.add_argument(
+    "--checkpoint",
+    help="Number of files after which plugins flush their state and files "
+    "are recorded as processed",
+    type=int,
+    default=100,
+)
+parser.add_argument(
+    "--rescan",
+    action="store_true",
+    help="Check all files against the list of processed files, not only "
+    "files newer than the last processed one",
+)
+parser.add_argument(
+    "--columnar",
+    action="store_true",
+    help="Convert export files to a columnar store (requires numpy)",
+)
+parser.add_argument(
+    "--enrich",
+    action="store_true",
+    help="Add user, device and team details from mapping files to events",
+)
+parser.add_argument(
+    "--no-dedup",
+    action="store_true",
+    help="Hand events to plugins even if an event with the same id was "
+    "processed before",
+)
+parser.add_argument(
+    "--watch",
+    type=float,
+    metavar="SECONDS",
+    help="Keep running, processing new files every SECONDS",
+)
+parser.add_argument(
+    "--export",
+    metavar="ARGS",
+    help="In --watch mode, run the data exporter with these arguments before "
+    "processing new files (--dir is set to the processor's)",
+)
+parser.add_argument(
+    "--exporter",
+    help="Path to the data exporter script",
+    default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "../data-exporter/credo-data-exporter.py",
+    ),
+)
+parser.add_argument(
+    "--metrics", help="Append timings of files and plugins to this file as JSON lines"
+)
+parser.add_argument(
+    "--prometheus",
+    help="Write totals of plugin timings to this file in Prometheus text format",
+)
+parser.add_argument(
+    "--profile", help="Profile plugins with cProfile, saving results to this directory"
+)
+parser.add_argument(
+    "--tracemalloc",
+    action="store_true",
+    help="Measure peak memory allocated by each plugin call",
+)
 
 args = parser.parse_args()
 
 args.dir = args.dir.rstrip("/")
 args.plugin_dir = args.plugin_dir.rstrip("/")
 
+EXPORT_NAME = re.compile(r"export_(\d+)_(\d+)\.json(\.gz|\.zst)?$")
+
+# Events read from a file are handed to plugins in batches of FANOUT_BATCH,
+# reading stays at most FANOUT_QUEUE batches ahead of the slowest plugin
+FANOUT_BATCH = 256
+FANOUT_QUEUE = 8
+
+ledger = None
+registry = []
+worker_plugins = []
+plugin_states = {}
+frame_store = None
+frame_store_lock = multiprocessing.Lock()
+mapping_cache = None
+metrics = None
+seen_ids = {}
+file_ids = set()
+held_events = []
+held_until = None
+plugin_threads = {}
+
+if args.columnar:
+    import credo_blobs
+    import credo_columns
+
 
 def prepare_workspace():
     if not os.path.exists(args.dir):
@@ -45,76 +156,772 @@ def prepare_workspace():
     if not os.path.exists(args.dir + "/pings"):
         os.makedirs(args.dir + "/pings")
 
-    if not os.path.exists(args.dir + "/processed_detections"):
-        with open(args.dir + "/processed_detections", "w+") as _:
-            pass
 
-    if not os.path.exists(args.dir + "/processed_pings"):
-        with open(args.dir + "/processed_pings", "w+") as _:
-            pass
+def open_ledger():
+    # Processed files are recorded by their export_<since>_<until> range.
+    # Files are exported in time order, so everything after the last recorded
+    # range is new and earlier files never have to be looked up.
+    db = sqlite3.connect(args.dir + "/processed.sqlite")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS processed "
+        "(data_type TEXT, until INTEGER, since INTEGER, name TEXT, "
+        "PRIMARY KEY (data_type, until, since))"
+    )
+    credo_seen.SeenIds.create_table(db)
+
+    # Import ledgers of older versions, which kept file names in text files
+    for data_type in ["detection", "ping"]:
+        path = "{}/processed_{}s".format(args.dir, data_type)
+        if not os.path.exists(path):
+            continue
+
+        with open(path) as f:
+            names = f.read().splitlines(False)
+
+        record_files(db, data_type, names)
+        db.commit()
+        os.rename(path, path + ".old")
+        args.rescan = True
+
+    return db
+
+
+def parse_export_name(name):
+    match = EXPORT_NAME.match(name)
+    if match is None:
+        return None
+
+    return int(match.group(2)), int(match.group(1))
+
+
+def record_files(db, data_type, names):
+    db.executemany(
+        "INSERT OR IGNORE INTO processed VALUES (?, ?, ?, ?)",
+        (
+            (data_type,) + parse_export_name(name) + (name,)
+            for name in names
+            if parse_export_name(name) is not None
+        ),
+    )
 
 
 def get_new_files(data_type):
-    with open("{}/processed_{}s".format(args.dir, data_type)) as f:
-        files_old = set(f.read().splitlines(False))
-    files_current = set(os.listdir("{}/{}s".format(args.dir, data_type)))
-    return files_current - files_old
+    last = ledger.execute(
+        "SELECT until, since FROM processed WHERE data_type = ? "
+        "ORDER BY until DESC, since DESC LIMIT 1",
+        (data_type,),
+    ).fetchone()
+
+    files = []
+    for entry in os.scandir("{}/{}s".format(args.dir, data_type)):
+        key = parse_export_name(entry.name)
+        if key is None:
+            continue
+
+        if last is None or key > last:
+            files.append((key, entry.name))
+        elif (
+            args.rescan
+            and not ledger.execute(
+                "SELECT 1 FROM processed WHERE data_type = ? AND until = ? AND since = ?",
+                (data_type,) + key,
+            ).fetchone()
+        ):
+            files.append((key, entry.name))
+
+    # Oldest first
+    files.sort()
+    return [name for _, name in files]
+
+
+def open_export(path):
+    # Export files may be compressed by the exporter (--compress)
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+
+    if path.endswith(".zst"):
+        import zstandard
+
+        return io.TextIOWrapper(
+            zstandard.ZstdDecompressor().stream_reader(open(path, "rb")),
+            encoding="utf-8",
+        )
+
+    return io.open(path, encoding="utf-8")
+
+
+def keep_event(event, seen):
+    # Events processed before, e.g. exported again at the boundary of two
+    # export files, are not handed to plugins. Workers hold back events
+    # received up to the end of the previous file for the main process, as
+    # those may repeat events of that file which is not processed yet.
+    if event["id"] in seen:
+        return False
 
+    if held_until is not None and event["time_received"] <= held_until:
+        held_events.append(event)
+        return False
+
+    file_ids.add(event["id"])
+    return True
+
+
+def skip_seen_batch(batch, data_type):
+    unseen = ~seen_ids[data_type].contains_array(batch["id"])
+    if held_until is not None:
+        unseen &= batch["time_received"] > held_until
+
+    file_ids.update(batch["id"][unseen].tolist())
+
+    if unseen.all():
+        return batch
+    return {name: column[unseen] for name, column in batch.items()}
+
+
+def hold_boundary(path, data_type):
+    # Holds back events for the main process like keep_event() in workers
+    # which do not read the file otherwise. Events are exported in order of
+    # time_received, so those to hold back come first.
+    seen = seen_ids[data_type]
+
+    with open_export(path) as f:
+        for event in credo_json.iter_array(f, data_type + "s"):
+            if event["time_received"] > held_until:
+                break
+
+            if event["id"] not in seen:
+                held_events.append(event)
+
+
+def boundary_events(held, data_type):
+    # Events held back by a worker which were not processed before
+    seen = seen_ids[data_type]
+    boundary = [event for event in held if event["id"] not in seen]
+    file_ids.update(event["id"] for event in boundary)
+
+    if args.enrich:
+        boundary = list(mapping_cache.enrich(boundary, data_type))
+
+    return boundary
+
+
+def plugin_thread(name):
+    # Every call of a plugin runs on a thread of its own, so several plugins
+    # can consume a single read of a file while anything made by setup()
+    # (e.g. an SQLite connection) stays on the thread which made it.
+    if name not in plugin_threads:
+        plugin_threads[name] = ThreadPoolExecutor(1, thread_name_prefix=name)
+
+    return plugin_threads[name]
+
+
+def run_step(name, step, data_type, path, events, function, *args):
+    with metrics.plugin(name, step, data_type, path) as call:
+        call["events"] = events
+        return function(*args)
+
+
+def call_step(plugin, step, data_type, path, events, function, *args):
+    return (
+        plugin_thread(plugin.__name__)
+        .submit(
+            run_step, plugin.__name__, step, data_type, path, events, function, *args
+        )
+        .result()
+    )
+
+
+def call_hook(plugin, hook, *args):
+    return plugin_thread(plugin.__name__).submit(getattr(plugin, hook), *args).result()
+
+
+def consume(name, step, data_type, path, function, batches, copy):
+    # Runs function on the events of the batches read_once() puts in the
+    # queue, until None. Each plugin gets its own copies of the events,
+    # which it is free to modify.
+    ended = []
+
+    def feed(call):
+        for batch in iter(batches.get, None):
+            call["events"] += len(batch)
+            for event in batch:
+                yield dict(event) if copy else event
+
+        ended.append(True)
+
+    try:
+        with metrics.plugin(name, step, data_type, path, threaded=True) as call:
+            call["events"] = 0
+            return function(feed(call))
+    finally:
+        # Lets reading go on when the function stopped early
+        if not ended:
+            for _ in iter(batches.get, None):
+                pass
+
+
+def batched(events):
+    batch = []
+    for event in events:
+        batch.append(event)
+        if len(batch) == FANOUT_BATCH:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def read_once(path, data_type, consumers, convert):
+    # Decodes the file once, handing its new events to consumers, which are
+    # (name, step, function) tuples. Each function gets an iterator over the
+    # events and runs on the thread of its name, starting with the first new
+    # event. Returns the results of the functions, or None without any new
+    # events. With convert, all events are written to the columnar store.
+    file = os.path.basename(path)
+    seen = seen_ids.get(data_type)
+    futures = []
+    queues = []
+
+    def start(name, step, function, copy):
+        batches = queue.Queue(FANOUT_QUEUE)
+        futures.append(
+            plugin_thread(name).submit(
+                consume, name, step, data_type, path, function, batches, copy
+            )
+        )
+        queues.append(batches)
+        return batches
+
+    def write_columns(events):
+        credo_columns.write_columns(args.dir, data_type, file, events)
+
+    converted = [start("columnar", "convert", write_columns, False)] if convert else []
+    consumed = None
+
+    try:
+        with metrics.plugin("export", "read", data_type, path) as call:
+            call["events"] = 0
+
+            with open_export(path) as f:
+                # With the columnar store, plugins get frames as references to
+                # the frame store. Frames of a new file are stored while it is
+                # converted, those of a converted file are not even decoded.
+                frames = data_type == "detection" and args.columnar
+                if frames and credo_columns.has_columns(args.dir, data_type, file):
+                    events = frame_store.attach(
+                        credo_json.iter_array(f, "detections", skip=["frame_content"]),
+                        *credo_columns.load_frame_refs(args.dir, file)
+                    )
+                else:
+                    events = credo_json.iter_array(f, data_type + "s")
+                store_frames = frames and convert
+
+                if metrics.enabled:
+                    events = metrics.timed(events)
+
+                for batch in batched(events):
+                    call["events"] += len(batch)
+                    if store_frames:
+                        batch = frame_store.store(batch)
+                    for batches in converted:
+                        batches.put(batch)
+
+                    if not args.no_dedup:
+                        batch = [e for e in batch if keep_event(e, seen)]
+                    if not batch:
+                        continue
+
+                    if args.enrich:
+                        batch = list(mapping_cache.enrich(batch, data_type))
+
+                    if consumed is None:
+                        consumed = [start(*consumer, True) for consumer in consumers]
+                    for batches in consumed:
+                        batches.put(batch)
+    finally:
+        for batches in queues:
+            batches.put(None)
+
+    results = [future.result() for future in futures]
+    if consumed is None:
+        return None
+
+    return results[len(converted) :]
+
+
+def read_file(path, data_type, plugins, convert=False):
+    # Runs the map and process steps of plugins on one file, decoding it at
+    # most once. Returns partial results of map steps keyed by plugin name,
+    # or None if the file has no new events.
+    name = data_type + "s"
+    file = os.path.basename(path)
+    consumers = []
+    batch_plugins = []
 
-def process_detections(detections, plugins):
     for p in plugins:
-        p.process_detections(detections, args.dir)
+        if hasattr(p, "map_{}_batch".format(name)) or (
+            not is_mapped(p, data_type) and hasattr(p, "process_{}_batch".format(name))
+        ):
+            batch_plugins.append(p)
+        else:
+            consumers.append(stream_step(p, data_type))
+
+    if batch_plugins or args.columnar:
+        import credo_columns
 
+    # Without the columnar store, arrays are built from the same read
+    if batch_plugins and not args.columnar:
+        consumers.append(
+            (
+                "batch",
+                "build",
+                lambda events: credo_columns.build_columns(events, data_type),
+            )
+        )
+
+    convert = (
+        convert
+        and args.columnar
+        and not credo_columns.has_columns(args.dir, data_type, file)
+    )
+
+    read = bool(consumers or convert)
+    results = []
+    if read:
+        results = read_once(path, data_type, consumers, convert)
+        if results is None:
+            return None
+    elif held_until is not None and not args.no_dedup:
+        hold_boundary(path, data_type)
+
+    partials = {
+        plugin_name: result
+        for (plugin_name, step, _), result in zip(consumers, results)
+        if step == "map"
+    }
+
+    if not batch_plugins:
+        return partials
+
+    if args.columnar:
+        batch = credo_columns.read_columns(args.dir, data_type, file)
+        if not args.no_dedup:
+            batch = skip_seen_batch(batch, data_type)
+
+        if not read and not len(batch["id"]):
+            return None
+    else:
+        batch = results[-1]
+
+    # Arrays are shared by all batch plugins
+    for p in batch_plugins:
+        if is_mapped(p, data_type):
+            function = getattr(p, "map_{}_batch".format(name))
+            partials[p.__name__] = call_step(
+                p, "map", data_type, path, len(batch["id"]), function, batch, args.dir
+            )
+        else:
+            function = getattr(p, "process_{}_batch".format(name))
+            call_step(
+                p,
+                "process",
+                data_type,
+                path,
+                len(batch["id"]),
+                function,
+                batch,
+                *plugin_args(p)
+            )
+
+    return partials
+
+
+def is_mapped(plugin, data_type):
+    return hasattr(plugin, "map_{}s".format(data_type)) or hasattr(
+        plugin, "map_{}s_batch".format(data_type)
+    )
+
+
+def stream_step(plugin, data_type):
+    name = data_type + "s"
+
+    if hasattr(plugin, "map_" + name):
+        function = getattr(plugin, "map_" + name)
+        return plugin.__name__, "map", lambda events: function(events, args.dir)
+
+    function = getattr(plugin, "process_" + name)
+    return (
+        plugin.__name__,
+        "process",
+        lambda events: function(events, *plugin_args(plugin)),
+    )
+
+
+def map_events(plugin, events, path, data_type):
+    # Map step over a list of events already read from the file
+    name = data_type + "s"
+
+    if hasattr(plugin, "map_{}_batch".format(name)):
+        import credo_columns
+
+        function = getattr(plugin, "map_{}_batch".format(name))
+        events_arg = credo_columns.build_columns(iter(events), data_type)
+    else:
+        function = getattr(plugin, "map_" + name)
+        events_arg = (dict(event) for event in events)
+
+    return call_step(
+        plugin, "map", data_type, path, len(events), function, events_arg, args.dir
+    )
+
+
+def plugin_args(plugin):
+    # Plugins with a setup() hook get their state as an extra argument.
+    if plugin.__name__ in plugin_states:
+        return args.dir, plugin_states[plugin.__name__]
+
+    return (args.dir,)
+
+
+def process(path, data_type, plugins, partials=None, boundary=None, convert=False):
+    # Without partials the whole file is read here. Otherwise workers already
+    # ran the map steps and only the other plugins read the file, while
+    # boundary events held back by workers are mapped here.
+    name = data_type + "s"
+    plugins = [p for p in plugins if data_type in p.data_types]
+
+    if partials is None:
+        partials = read_file(path, data_type, plugins, convert)
+        if partials is None:
+            return
+    else:
+        rest = [p for p in plugins if not is_mapped(p, data_type)]
+        partials = dict(partials, **(read_file(path, data_type, rest) or {}))
 
-def process_pings(pings, plugins):
     for p in plugins:
-        p.process_pings(pings, args.dir)
+        if not is_mapped(p, data_type):
+            continue
 
+        mapped = [partials[p.__name__]]
+        if boundary:
+            mapped.append(map_events(p, boundary, path, data_type))
 
-def process(events, plugins):
-    if events.get("detections"):
-        process_detections(events["detections"], plugins)
-    elif events.get("pings"):
-        process_pings(events["pings"], plugins)
+        for partial in mapped:
+            call_step(
+                p,
+                "reduce",
+                data_type,
+                path,
+                0,
+                getattr(p, "reduce_" + name),
+                partial,
+                *plugin_args(p)
+            )
 
 
-def process_new(data_type):
-    specs = [
-        importlib.util.spec_from_file_location(
-            file, "{}/{}".format(args.plugin_dir, file)
+def plugin_data_types(plugin):
+    # Plugins may declare the data types they handle in DATA_TYPES, otherwise
+    # it is inferred from the functions they define.
+    if hasattr(plugin, "DATA_TYPES"):
+        return list(plugin.DATA_TYPES)
+
+    return [
+        data_type
+        for data_type in ["detection", "ping"]
+        if any(
+            hasattr(plugin, f.format(data_type))
+            for f in ["process_{}s", "process_{}s_batch", "map_{}s", "map_{}s_batch"]
         )
-        for file in os.listdir(args.plugin_dir)
-        if file.endswith(".py")
     ]
 
-    plugins = [importlib.util.module_from_spec(spec) for spec in specs]
 
-    for spec, plugin in zip(specs, plugins):
+def load_plugins(verbose=True):
+    # Source files are compiled through the standard loader, which caches
+    # bytecode in __pycache__ of the plugin directory.
+    plugins = []
+
+    for file in sorted(os.listdir(args.plugin_dir)):
+        if not file.endswith(".py"):
+            continue
+
+        spec = importlib.util.spec_from_file_location(
+            file[: -len(".py")], "{}/{}".format(args.plugin_dir, file)
+        )
+        plugin = importlib.util.module_from_spec(spec)
+
+        started = time.perf_counter()
         spec.loader.exec_module(plugin)
-        print("Loaded plugin: {}".format(plugin))
+        elapsed = time.perf_counter() - started
+
+        plugin.data_types = plugin_data_types(plugin)
+        plugins.append(plugin)
+
+        if verbose:
+            print(
+                "Loaded plugin {} for {} in {:.1f} ms".format(
+                    plugin.__name__,
+                    "/".join(plugin.data_types) or "nothing",
+                    elapsed * 1000,
+                )
+            )
+
+    return plugins
+
+
+def setup_plugins(plugins):
+    for p in plugins:
+        if hasattr(p, "setup"):
+            plugin_states[p.__name__] = call_hook(p, "setup", args.dir)
+
+
+def flush_plugins(plugins):
+    for p in plugins:
+        if hasattr(p, "flush"):
+            call_hook(p, "flush", plugin_states.get(p.__name__))
+
+
+def teardown_plugins(plugins):
+    for p in plugins:
+        if hasattr(p, "teardown"):
+            call_hook(p, "teardown", plugin_states.get(p.__name__))
+
+    plugin_states.clear()
+
+    for thread in plugin_threads.values():
+        thread.shutdown()
+    plugin_threads.clear()
+
+
+def init_worker(lock, data_type, seen):
+    global worker_plugins, frame_store, mapping_cache, metrics
+
+    # Ids seen before are passed on explicitly, as workers which are not
+    # forked do not inherit them
+    seen_ids[data_type] = seen
+
+    # Stopping --watch mode is up to the main process
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    # Threads of the main process do not exist in forked workers
+    plugin_threads.clear()
+
+    # Forked workers inherit plugins and mappings loaded by the main process
+    worker_plugins = registry or load_plugins(verbose=False)
 
-    for file in get_new_files(data_type):
-        with open("{}/{}s/{}".format(args.dir, data_type, file)) as f:
-            events = json.load(f)
+    if args.enrich and mapping_cache is None:
+        mapping_cache = credo_mappings.MappingCache(args.dir)
 
-        process(events, plugins)
-        del events
+    # Metrics of workers are sent back with their results, profiles are only
+    # collected in the main process
+    if metrics is None:
+        metrics = credo_metrics.Metrics(trace_memory=args.tracemalloc)
+    metrics.profile_dir = None
 
-        with open("{}/processed_{}s".format(args.dir, data_type), "a") as f:
-            f.write("{}\n".format(file))
+    if args.columnar:
+        frame_store = credo_blobs.FrameStore(args.dir, lock)
 
-        if args.delete:
+
+def map_file(task):
+    # Runs in a worker process, returns None for files without new events
+    # and partial results of map/reduce plugins keyed by plugin name
+    # otherwise, together with metric events recorded meanwhile, ids of the
+    # events handed to plugins and events held back for the main process.
+    # Events received up to until of the previous file, if it is processed in
+    # the same run, are held back.
+    global held_until
+
+    path, data_type, held_until = task
+    metrics.buffer = []
+    file_ids.clear()
+    del held_events[:]
+
+    mapped = [
+        p
+        for p in worker_plugins
+        if data_type in p.data_types and is_mapped(p, data_type)
+    ]
+    partials = read_file(path, data_type, mapped, convert=True)
+
+    # Frames attached from the frame store are sent back as base64
+    held = [
+        (
+            dict(e, frame_content=str(e["frame_content"]))
+            if e.get("frame_content") is not None
+            else e
+        )
+        for e in held_events
+    ]
+
+    return partials, metrics.buffer, list(file_ids), held
+
+
+def checkpoint(data_type, plugins, files):
+    # Plugins persist their state before files are recorded as processed, so
+    # a crash in between makes files be processed again rather than skipped.
+    if not files:
+        return
+
+    # Only plugins handling this data type have anything to persist
+    flush_plugins([p for p in plugins if data_type in p.data_types])
+
+    # Ids of events handed to plugins are committed with the files they
+    # come from
+    seen_ids[data_type].save(ledger, data_type)
+    record_files(ledger, data_type, files)
+    ledger.commit()
+
+    metrics.write_prometheus()
+
+    if args.delete:
+        for file in files:
             os.remove("{}/{}s/{}".format(args.dir, data_type, file))
 
+    del files[:]
 
-def main():
+
+def process_new(data_type, plugins):
+    files = list(get_new_files(data_type))
+    paths = ["{}/{}s/{}".format(args.dir, data_type, file) for file in files]
+
+    # In --watch mode the set is kept between cycles, it is saved with every
+    # checkpoint
+    if data_type not in seen_ids:
+        seen_ids[data_type] = credo_seen.SeenIds.load(ledger, data_type)
+    file_ids.clear()
+
+    # Workers parse files and run the map step ahead of time, results come
+    # back in order so the ledger below stays consistent.
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(
+            args.jobs,
+            initializer=init_worker,
+            initargs=(frame_store_lock, data_type, seen_ids[data_type]),
+        )
+        # Ids of files processed before this run are already known to workers
+        previous = [None] + [parse_export_name(file)[0] for file in files[:-1]]
+        results = pool.imap(
+            map_file, [(path, data_type, until) for path, until in zip(paths, previous)]
+        )
+    else:
+        pool = None
+        results = ((None, [], [], []) for path in paths)
+
+    processed = []
+
+    try:
+        for file, path, (partials, records, ids, held) in zip(files, paths, results):
+            with metrics.file(data_type, path):
+                for record in records:
+                    metrics.record(record)
+
+                if pool is None:
+                    process(path, data_type, plugins, convert=True)
+                else:
+                    file_ids.update(ids)
+                    boundary = boundary_events(held, data_type)
+
+                    # Without any other new events the whole file is read
+                    # here, boundary included
+                    if partials is not None:
+                        process(path, data_type, plugins, partials, boundary)
+                    elif boundary:
+                        process(path, data_type, plugins)
+
+            seen_ids[data_type].update(file_ids)
+            file_ids.clear()
+
+            processed.append(file)
+
+            if len(processed) >= args.checkpoint:
+                checkpoint(data_type, plugins, processed)
+
+        checkpoint(data_type, plugins, processed)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def process_all(plugins):
     if args.data_type in ["detection", "all"]:
         print("Processing new detections")
-        process_new("detection")
+        process_new("detection", plugins)
 
     if args.data_type in ["ping", "all"]:
         print("Processing new pings")
-        process_new("ping")
+        process_new("ping", plugins)
+
+
+def load_exporter():
+    # The exporter runs in this process, so its HTTP session and token are
+    # kept between cycles. Its helper modules are next to it.
+    sys.path.insert(0, os.path.dirname(os.path.abspath(args.exporter)))
+    spec = importlib.util.spec_from_file_location("credo_data_exporter", args.exporter)
+    exporter = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(exporter)
+
+    exporter.configure(shlex.split(args.export) + ["--dir", args.dir])
+    exporter.prepare_workspace()
+    return exporter
+
+
+def watch(plugins):
+    # Plugins, their state and the ledger stay loaded while new files are
+    # exported and processed every args.watch seconds. Files are only
+    # listed, not checked against the ledger again after the first cycle.
+    exporter = load_exporter() if args.export is not None else None
+
+    # Stop on SIGTERM like on Ctrl+C, so plugins are torn down
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    try:
+        while True:
+            started = time.time()
+
+            if exporter is not None:
+                try:
+                    exporter.main()
+                except Exception as e:
+                    print("Export failed, retrying next cycle: {!r}".format(e))
+
+            process_all(plugins)
+            args.rescan = False
+
+            time.sleep(max(0, args.watch - (time.time() - started)))
+    except KeyboardInterrupt:
+        print("Stopping")
+
+
+def main():
+    global frame_store, ledger, mapping_cache, metrics, registry
+
+    metrics = credo_metrics.Metrics(
+        args.metrics, args.prometheus, args.profile, args.tracemalloc
+    )
+    started = time.perf_counter()
+
+    ledger = open_ledger()
+
+    if args.enrich:
+        mapping_cache = credo_mappings.MappingCache(args.dir)
+
+    if args.columnar:
+        frame_store = credo_blobs.FrameStore(args.dir, frame_store_lock)
+
+    plugins = registry = load_plugins()
+    setup_plugins(plugins)
+
+    try:
+        if args.watch:
+            watch(plugins)
+        else:
+            process_all(plugins)
+    finally:
+        teardown_plugins(plugins)
+
+        metrics.emit("run", seconds=time.perf_counter() - started)
+        metrics.write_prometheus()
+        metrics.dump_profiles()
 
 
 if __name__ == "__main__":
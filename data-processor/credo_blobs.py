@@ -0,0 +1,133 @@
+import base64
+import hashlib
+import os
+import sqlite3
+import threading
+
+
+class FrameContent(object):
+    # Lazy reference to a frame stored in a FrameStore. The image is read
+    # from disk only when read() is called, str() gives back the base64 form
+    # used in export files.
+
+    __slots__ = ("store", "offset", "length")
+
+    def __init__(self, store, offset, length):
+        self.store = store
+        self.offset = offset
+        self.length = length
+
+    def read(self):
+        return self.store.read(self.offset, self.length)
+
+    def __str__(self):
+        return base64.b64encode(self.read()).decode("ascii")
+
+    def __repr__(self):
+        return "<FrameContent offset={} length={}>".format(self.offset, self.length)
+
+
+class FrameStore(object):
+    # Content-addressed store of frame images: one append-only pack file and
+    # an SQLite index from SHA-1 of the image to its offset and length in the
+    # pack. Frames are first spooled to a private file, then appended to the
+    # pack while holding the lock, so several processes can ingest at once.
+
+    def __init__(self, data_dir, lock=None):
+        self.path = data_dir + "/blobs"
+        self.pack_path = self.path + "/frames.pack"
+        self.lock = lock if lock is not None else threading.Lock()
+        self.reader = None
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        # Frames are added from the thread converting a file
+        self.index = sqlite3.connect(
+            self.path + "/frames.idx", timeout=60, check_same_thread=False
+        )
+        self.index.execute(
+            "CREATE TABLE IF NOT EXISTS frames "
+            "(digest BLOB PRIMARY KEY, offset INTEGER, length INTEGER) "
+            "WITHOUT ROWID"
+        )
+        self.index.commit()
+
+    def add_all(self, frames):
+        # Stores base64 encoded frames, returns (offset, length) of each one,
+        # (-1, 0) for missing frames.
+        spool_path = "{}/spool_{}".format(self.path, os.getpid())
+        digests = []
+
+        with open(spool_path, "wb") as spool:
+            for frame in frames:
+                if frame:
+                    data = base64.b64decode(frame)
+                    spool.write(data)
+                    digests.append((hashlib.sha1(data).digest(), len(data)))
+                else:
+                    digests.append((None, 0))
+
+        try:
+            with self.lock:
+                return self.append(spool_path, digests)
+        finally:
+            os.remove(spool_path)
+
+    def append(self, spool_path, digests):
+        refs = []
+
+        with open(spool_path, "rb") as spool, open(self.pack_path, "ab") as pack:
+            pack.seek(0, os.SEEK_END)
+
+            for digest, length in digests:
+                if digest is None:
+                    refs.append((-1, 0))
+                    continue
+
+                data = spool.read(length)
+                row = self.index.execute(
+                    "SELECT offset, length FROM frames WHERE digest = ?", (digest,)
+                ).fetchone()
+
+                if row is None:
+                    row = (pack.tell(), length)
+                    pack.write(data)
+                    self.index.execute(
+                        "INSERT INTO frames VALUES (?, ?, ?)", (digest,) + row
+                    )
+
+                refs.append(row)
+
+        self.index.commit()
+        return refs
+
+    def read(self, offset, length):
+        # Plugin threads read frames at once, so without seeking
+        if self.reader is None:
+            self.reader = open(self.pack_path, "rb")
+
+        return os.pread(self.reader.fileno(), length, offset)
+
+    def store(self, events):
+        # Stores frames of a list of events, replacing their frame_content
+        # with FrameContent references.
+        refs = self.add_all([event.get("frame_content") for event in events])
+
+        for event, (offset, length) in zip(events, refs):
+            if offset >= 0:
+                event["frame_content"] = FrameContent(self, offset, length)
+            else:
+                event["frame_content"] = None
+
+        return events
+
+    def attach(self, events, offsets, lengths):
+        # Replaces frame_content of events with FrameContent references,
+        # offsets and lengths are in the same order as events.
+        for event, offset, length in zip(events, offsets, lengths):
+            if offset >= 0:
+                event["frame_content"] = FrameContent(self, int(offset), int(length))
+            else:
+                event["frame_content"] = None
+            yield event
@@ -0,0 +1,169 @@
+import array
+import os
+import shutil
+
+import numpy as np
+
+# name, array typecode, numpy dtype, value stored for missing fields
+COLUMNS = {
+    "detection": [
+        ("id", "q", np.int64, -1),
+        ("user_id", "q", np.int64, -1),
+        ("device_id", "q", np.int64, -1),
+        ("team_id", "q", np.int64, -1),
+        ("timestamp", "q", np.int64, -1),
+        ("time_received", "q", np.int64, -1),
+        ("x", "i", np.int32, -1),
+        ("y", "i", np.int32, -1),
+        ("width", "i", np.int32, -1),
+        ("height", "i", np.int32, -1),
+        ("latitude", "d", np.float64, float("nan")),
+        ("longitude", "d", np.float64, float("nan")),
+        ("visible", "B", np.bool_, 0),
+    ],
+    "ping": [
+        ("id", "q", np.int64, -1),
+        ("user_id", "q", np.int64, -1),
+        ("device_id", "q", np.int64, -1),
+        ("timestamp", "q", np.int64, -1),
+        ("time_received", "q", np.int64, -1),
+        ("on_time", "q", np.int64, -1),
+        ("delta_time", "q", np.int64, -1),
+    ],
+}
+
+
+# references to frames in the frame store, saved along with detection columns
+FRAME_COLUMNS = [("frame_offset", np.int64), ("frame_length", np.int32)]
+
+
+def columns_dir(data_dir, data_type):
+    return "{}/columns/{}s".format(data_dir, data_type)
+
+
+def export_columns_dir(data_dir, data_type, export_file):
+    return "{}/{}".format(
+        columns_dir(data_dir, data_type), export_file.split(".", 1)[0]
+    )
+
+
+def has_columns(data_dir, data_type, export_file):
+    return os.path.isdir(export_columns_dir(data_dir, data_type, export_file))
+
+
+def collect_columns(events, data_type, values):
+    # Appends fields of each event to typed arrays (a few bytes per value)
+    # and yields its frame_content, so frames can be stored as they stream by.
+    columns = COLUMNS[data_type]
+
+    for event in events:
+        for (name, _, _, missing), column in zip(columns, values):
+            value = event.get(name)
+            column.append(missing if value is None else value)
+
+        yield event.get("frame_content")
+
+
+def build_columns(events, data_type):
+    # Builds an in-memory batch of columns from an iterator of events.
+    columns = COLUMNS[data_type]
+    values = [array.array(typecode) for _, typecode, _, _ in columns]
+
+    for _ in collect_columns(events, data_type, values):
+        pass
+
+    return {
+        name: np.frombuffer(column, dtype)
+        for (name, _, dtype, _), column in zip(columns, values)
+    }
+
+
+def write_columns(data_dir, data_type, export_file, events):
+    # Columns are saved as one .npy file each. Frames of detections must
+    # already be in the frame store (see FrameStore.store), the frame_offset
+    # and frame_length columns point to them.
+    path = export_columns_dir(data_dir, data_type, export_file)
+    tmp_path = path + ".tmp"
+
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    columns = COLUMNS[data_type]
+    values = [array.array(typecode) for _, typecode, _, _ in columns]
+    frames = collect_columns(events, data_type, values)
+
+    if data_type == "detection":
+        refs = [(-1, 0) if f is None else (f.offset, f.length) for f in frames]
+        np.save(
+            tmp_path + "/frame_offset.npy",
+            np.array([offset for offset, _ in refs], dtype=np.int64),
+        )
+        np.save(
+            tmp_path + "/frame_length.npy",
+            np.array([length for _, length in refs], dtype=np.int32),
+        )
+    else:
+        for _ in frames:
+            pass
+
+    for (name, _, dtype, _), column in zip(columns, values):
+        np.save("{}/{}.npy".format(tmp_path, name), np.frombuffer(column, dtype))
+
+    os.rename(tmp_path, path)
+
+
+def read_columns(data_dir, data_type, export_file, names=None):
+    # Memory-maps columns of a single export file.
+    path = export_columns_dir(data_dir, data_type, export_file)
+
+    if names is None:
+        names = [name for name, _, _, _ in COLUMNS[data_type]]
+
+    return {
+        name: np.load("{}/{}.npy".format(path, name), mmap_mode="r") for name in names
+    }
+
+
+def load_frame_refs(data_dir, export_file):
+    path = export_columns_dir(data_dir, "detection", export_file)
+
+    return (
+        np.load(path + "/frame_offset.npy", mmap_mode="r"),
+        np.load(path + "/frame_length.npy", mmap_mode="r"),
+    )
+
+
+def iter_columns(data_dir, data_type, names=None):
+    # Yields one dict of memory-mapped columns per export file, oldest first.
+    if not os.path.isdir(columns_dir(data_dir, data_type)):
+        return
+
+    exports = [
+        name
+        for name in os.listdir(columns_dir(data_dir, data_type))
+        if not name.endswith(".tmp")
+    ]
+    exports.sort(key=lambda name: [int(part) for part in name.split("_")[1:]])
+
+    for export in exports:
+        yield read_columns(data_dir, data_type, export, names)
+
+
+def load_columns(data_dir, data_type, names=None):
+    # Concatenates columns of all export files into in-memory arrays.
+    if names is None:
+        names = [name for name, _, _, _ in COLUMNS[data_type]]
+
+    dtypes = dict((name, dtype) for name, _, dtype, _ in COLUMNS[data_type])
+    if data_type == "detection":
+        dtypes.update(FRAME_COLUMNS)
+
+    chunks = list(iter_columns(data_dir, data_type, names))
+
+    return {
+        name: np.concatenate(
+            [chunk[name] for chunk in chunks] or [np.empty(0, dtypes[name])]
+        )
+        for name in names
+    }
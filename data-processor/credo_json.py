@@ -0,0 +1,64 @@
+import json
+import re
+
+READ_BLOCK_SIZE = 1024 * 1024
+
+SEPARATORS = re.compile(r"[\s,]*")
+
+WHITESPACE = re.compile(r"\s*")
+
+
+def iter_array(f, key, skip=()):
+    # Yields elements of the "key" array one at a time, so only a single
+    # element (plus one read block) is held in memory no matter how large the
+    # file is. Export files and mapping files are both read this way. String
+    # fields named in skip are read as null without being decoded.
+    decoder = json.JSONDecoder()
+    array_start = re.compile(r'"{}"\s*:\s*\['.format(re.escape(key)))
+    skipped = None
+    if skip:
+        names = "|".join(re.escape(name) for name in skip)
+        skipped = re.compile(r'"({})"\s*:\s*"[^"\\]*"'.format(names))
+    buf = ""
+    pos = None
+
+    while True:
+        block = f.read(READ_BLOCK_SIZE)
+        buf += block
+        if skipped is not None:
+            buf = skipped.sub(r'"\1": null', buf)
+
+        if pos is None:
+            match = array_start.search(buf)
+            if match is None:
+                if not block:
+                    return
+                continue
+            pos = match.end()
+
+        while True:
+            pos = SEPARATORS.match(buf, pos).end()
+            if pos == len(buf):
+                break
+            if buf[pos] == "]":
+                return
+            try:
+                element, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                break
+
+            # A number cut off at the end of the block also decodes (as a
+            # shorter one), so an element is only taken once the separator
+            # or the end of the array follows it
+            after = WHITESPACE.match(buf, end).end()
+            if block and (after == len(buf) or buf[after] not in ",]"):
+                break
+
+            pos = end
+            yield element
+
+        if not block:
+            raise ValueError("Unexpected end of {} data".format(key))
+
+        buf = buf[pos:]
+        pos = 0
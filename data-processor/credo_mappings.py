@@ -0,0 +1,113 @@
+import io
+import os
+
+import credo_json
+
+
+class User(object):
+    __slots__ = ("username", "display_name")
+
+    def __init__(self, entry):
+        self.username = entry.get("username")
+        self.display_name = entry.get("display_name")
+
+
+class Device(object):
+    __slots__ = ("device_model", "system_version", "device_type")
+
+    def __init__(self, entry):
+        self.device_model = entry.get("device_model")
+        self.system_version = entry.get("system_version")
+        self.device_type = entry.get("device_type")
+
+
+class Team(object):
+    __slots__ = ("name",)
+
+    def __init__(self, entry):
+        self.name = entry.get("name")
+
+
+RECORDS = {"user": User, "device": Device, "team": Team}
+
+# Event fields added by enrichment: (event field, mapping type, record field)
+ENRICHED_FIELDS = {
+    "detection": [
+        ("username", "user", "username"),
+        ("display_name", "user", "display_name"),
+        ("device_model", "device", "device_model"),
+        ("system_version", "device", "system_version"),
+        ("device_type", "device", "device_type"),
+        ("team_name", "team", "name"),
+    ],
+    "ping": [
+        ("username", "user", "username"),
+        ("display_name", "user", "display_name"),
+        ("device_model", "device", "device_model"),
+        ("system_version", "device", "system_version"),
+        ("device_type", "device", "device_type"),
+    ],
+}
+
+
+class MappingCache(object):
+    # Lookup tables from user, device and team ids to compact records built
+    # from the <type>_mapping.json files of the exporter. A table is loaded on
+    # first use and loaded again only when its file changes on disk.
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.tables = {}
+        self.versions = {}
+
+    def path(self, mapping_type):
+        return "{}/{}_mapping.json".format(self.data_dir, mapping_type)
+
+    def table(self, mapping_type):
+        try:
+            st = os.stat(self.path(mapping_type))
+            version = (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            version = None
+
+        if self.versions.get(mapping_type, False) != version:
+            self.tables[mapping_type] = self.load(mapping_type, version)
+            self.versions[mapping_type] = version
+
+        return self.tables[mapping_type]
+
+    def load(self, mapping_type, version):
+        if version is None:
+            return {}
+
+        record = RECORDS[mapping_type]
+        table = {}
+
+        with io.open(self.path(mapping_type), encoding="utf-8") as f:
+            for entry in credo_json.iter_array(f, mapping_type + "s"):
+                table[entry["id"]] = record(entry)
+
+        return table
+
+    def get(self, mapping_type, id):
+        return self.table(mapping_type).get(id)
+
+    def enrich(self, events, data_type):
+        # Adds mapped fields to each event, None where an id is unknown
+        fields = ENRICHED_FIELDS[data_type]
+        tables = {
+            mapping_type: self.table(mapping_type)
+            for mapping_type in set(f[1] for f in fields)
+        }
+
+        for event in events:
+            records = {
+                mapping_type: table.get(event.get(mapping_type + "_id"))
+                for mapping_type, table in tables.items()
+            }
+
+            for field, mapping_type, attr in fields:
+                record = records[mapping_type]
+                event[field] = getattr(record, attr) if record is not None else None
+
+            yield event
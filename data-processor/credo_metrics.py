@@ -0,0 +1,193 @@
+import collections
+import contextlib
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+# Fields of metric events summed into Prometheus counters, labelled by the
+# event's plugin, step and data_type
+COUNTERS = {
+    "plugin": ["seconds", "parse_seconds", "events"],
+    "file": ["seconds", "events"],
+}
+LABELS = ["plugin", "step", "data_type"]
+
+
+def write_prometheus(path, totals):
+    # Writes counters keyed by (name, labels) as a Prometheus textfile
+    lines = []
+    for name in sorted(set(name for name, _ in totals)):
+        lines.append("# TYPE {} counter".format(name))
+        for (metric, labels), value in sorted(totals.items()):
+            if metric != name:
+                continue
+
+            if labels:
+                name_labels = "{}{{{}}}".format(
+                    name, ",".join('{}="{}"'.format(k, v) for k, v in labels)
+                )
+            else:
+                name_labels = name
+            lines.append("{} {}".format(name_labels, value))
+
+    # Textfile collectors may read the file at any time
+    with open(path + ".tmp", "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(path + ".tmp", path)
+
+
+class Metrics(object):
+    # Timings of a processor run. Events are appended to a JSON lines file,
+    # their totals can be written as a Prometheus textfile, and plugin calls
+    # can be profiled with cProfile and tracemalloc. Worker processes buffer
+    # their events, which the main process then records in order. Events may
+    # be emitted from plugin threads.
+
+    def __init__(
+        self, path=None, prometheus_path=None, profile_dir=None, trace_memory=False
+    ):
+        self.path = path
+        self.prometheus_path = prometheus_path
+        self.profile_dir = profile_dir
+        self.trace_memory = trace_memory
+        self.enabled = bool(path or prometheus_path or profile_dir or trace_memory)
+
+        self.parse_seconds = 0.0
+        self.parsed_events = 0
+        self.file_events = 0
+        self.totals = collections.defaultdict(float)
+        self.profiles = {}
+        self.buffer = None
+        self.lock = threading.Lock()
+
+        if trace_memory:
+            tracemalloc.start()
+
+    def emit(self, event, **fields):
+        record = dict(time=time.time(), event=event, **fields)
+
+        with self.lock:
+            if self.buffer is not None:
+                self.buffer.append(record)
+            else:
+                self.record(record)
+
+    def record(self, record):
+        if record["event"] == "plugin":
+            self.file_events = max(self.file_events, record["events"])
+
+        if self.path:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+        labels = tuple((k, record[k]) for k in LABELS if k in record)
+        for field in COUNTERS.get(record["event"], []):
+            name = "credo_processor_{}_{}_total".format(record["event"], field)
+            self.totals[(name, labels)] += record[field]
+
+    def timed(self, events):
+        # Counts events and the time spent reading them, which is then left
+        # out of the time of the plugin consuming them
+        events = iter(events)
+        while True:
+            started = time.perf_counter()
+            event = next(events, None)
+            self.parse_seconds += time.perf_counter() - started
+
+            if event is None:
+                return
+
+            self.parsed_events += 1
+            yield event
+
+    def profile(self, name):
+        if not self.profile_dir:
+            return None
+
+        if name not in self.profiles:
+            self.profiles[name] = cProfile.Profile()
+        return self.profiles[name]
+
+    @contextlib.contextmanager
+    def plugin(self, name, step, data_type, path, threaded=False):
+        # Measures one call of a plugin on one file. Callers handing the
+        # plugin arrays instead of events set call["events"] themselves.
+        # Calls consuming events while the file is being read (threaded) are
+        # timed by the CPU time of their own thread, which excludes reading,
+        # and their memory use is not traced.
+        call = {}
+        clock = time.thread_time if threaded else time.perf_counter
+        trace_memory = self.trace_memory and not threaded
+        parse_seconds = self.parse_seconds
+        parsed_events = self.parsed_events
+        profile = self.profile(name)
+
+        if trace_memory:
+            tracemalloc.reset_peak()
+            traced = tracemalloc.get_traced_memory()[0]
+
+        started = clock()
+        if profile is not None:
+            try:
+                profile.enable()
+            except ValueError:
+                # Newer Pythons allow one active profiler per process
+                profile = None
+
+        try:
+            yield call
+        finally:
+            if profile is not None:
+                profile.disable()
+
+        seconds = clock() - started
+        parse = 0.0 if threaded else self.parse_seconds - parse_seconds
+        events = call.get("events", self.parsed_events - parsed_events)
+
+        fields = dict(
+            plugin=name,
+            step=step,
+            data_type=data_type,
+            file=os.path.basename(path),
+            seconds=seconds - parse,
+            parse_seconds=parse,
+            events=events,
+            events_per_second=events / seconds if seconds else None,
+        )
+        if trace_memory:
+            fields["peak_memory"] = tracemalloc.get_traced_memory()[1] - traced
+
+        self.emit("plugin", **fields)
+
+    @contextlib.contextmanager
+    def file(self, data_type, path):
+        self.file_events = 0
+        started = time.perf_counter()
+
+        yield
+
+        seconds = time.perf_counter() - started
+        self.emit(
+            "file",
+            data_type=data_type,
+            file=os.path.basename(path),
+            seconds=seconds,
+            events=self.file_events,
+            events_per_second=self.file_events / seconds if seconds else None,
+        )
+
+    def write_prometheus(self):
+        if self.prometheus_path:
+            with self.lock:
+                write_prometheus(self.prometheus_path, self.totals)
+
+    def dump_profiles(self):
+        if not self.profile_dir:
+            return
+
+        os.makedirs(self.profile_dir, exist_ok=True)
+        for name, profile in self.profiles.items():
+            profile.dump_stats("{}/{}.prof".format(self.profile_dir, name))
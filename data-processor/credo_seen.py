@@ -0,0 +1,80 @@
+PAGE_SHIFT = 16
+PAGE_MASK = (1 << PAGE_SHIFT) - 1
+PAGE_BYTES = (1 << PAGE_SHIFT) // 8
+
+
+class SeenIds(object):
+    # Set of integer event ids kept as a bitmap split into pages of 65536
+    # ids, allocating only pages which hold any id. Event ids are dense, so
+    # this takes about 125 kB per million ids (a set of ints takes ~60 MB).
+    # Pages changed since the last save() are tracked so only they are
+    # written back.
+
+    def __init__(self):
+        self.pages = {}
+        self.dirty = set()
+
+    def __contains__(self, id):
+        page = self.pages.get(id >> PAGE_SHIFT)
+        return page is not None and bool(page[(id & PAGE_MASK) >> 3] >> (id & 7) & 1)
+
+    def add(self, id):
+        key = id >> PAGE_SHIFT
+        page = self.pages.get(key)
+        if page is None:
+            page = self.pages[key] = bytearray(PAGE_BYTES)
+
+        page[(id & PAGE_MASK) >> 3] |= 1 << (id & 7)
+        self.dirty.add(key)
+
+    def update(self, ids):
+        for id in ids:
+            self.add(id)
+
+    def contains_array(self, ids):
+        # Vectorized membership test for a numpy array of ids
+        import numpy as np
+
+        result = np.zeros(len(ids), dtype=bool)
+        keys = ids >> PAGE_SHIFT
+
+        for key in np.unique(keys).tolist():
+            page = self.pages.get(key)
+            if page is None:
+                continue
+
+            selected = keys == key
+            offsets = ids[selected] & PAGE_MASK
+            bits = np.frombuffer(page, dtype=np.uint8)[offsets >> 3]
+            result[selected] = (bits >> (offsets & 7)) & 1
+
+        return result
+
+    def nbytes(self):
+        return len(self.pages) * PAGE_BYTES
+
+    @staticmethod
+    def create_table(db):
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS seen_ids "
+            "(data_type TEXT, page INTEGER, bits BLOB, "
+            "PRIMARY KEY (data_type, page)) WITHOUT ROWID"
+        )
+
+    @classmethod
+    def load(cls, db, data_type):
+        seen = cls()
+        for key, bits in db.execute(
+            "SELECT page, bits FROM seen_ids WHERE data_type = ?", (data_type,)
+        ):
+            seen.pages[key] = bytearray(bits)
+        return seen
+
+    def save(self, db, data_type):
+        # Writes changed pages without committing, so they are committed
+        # together with the files they come from
+        db.executemany(
+            "INSERT OR REPLACE INTO seen_ids VALUES (?, ?, ?)",
+            ((data_type, key, bytes(self.pages[key])) for key in sorted(self.dirty)),
+        )
+        self.dirty.clear()
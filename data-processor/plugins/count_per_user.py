@@ -1,29 +1,79 @@
-import collections
 import json
 import os
+import sqlite3
+from collections import Counter
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
-def process_detections(detections, data_dir):
-    # Create a file to store our results
-    if not os.path.isfile(data_dir + "/user_detection_count.json"):
-        with open(data_dir + "/user_detection_count.json", "w") as f:
-            f.write("{}")
+DATA_TYPES = ["detection"]
 
-    # Load previous results
-    with open(data_dir + "/user_detection_count.json", "r") as f:
-        c = collections.Counter(json.load(f))
 
-    # Update counter
-    for d in detections:
-        if d["visible"]:
-            c[str(d["user_id"])] += 1
+def setup(data_dir):
+    path = data_dir + "/user_detection_count.sqlite"
+    created = not os.path.isfile(path)
 
-    print("top 10 users after this batch: {}".format(c.most_common(10)))
+    db = sqlite3.connect(path)
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS counts "
+        "(user_id INTEGER PRIMARY KEY, count INTEGER NOT NULL)"
+    )
+    # Keeps the ranking ordered so the top users are read without a scan
+    db.execute("CREATE INDEX IF NOT EXISTS counts_by_count ON counts (count)")
 
-    # Save results
-    with open(data_dir + "/user_detection_count.json", "w") as f:
-        json.dump(c, f)
+    # Import results of older versions which kept everything in JSON
+    if created and os.path.isfile(data_dir + "/user_detection_count.json"):
+        with open(data_dir + "/user_detection_count.json") as f:
+            db.executemany(
+                "INSERT INTO counts VALUES (?, ?)",
+                ((int(user), count) for user, count in json.load(f).items()),
+            )
 
+    db.commit()
+    return db
 
-def process_pings(pings, data_dir):
-    pass
+
+def map_detections(detections, data_dir):
+    # Count visible detections per user in a single file, this part may run
+    # in a worker process
+    counts = Counter(d["user_id"] for d in detections if d["visible"])
+
+    return list(counts.items())
+
+
+# Without numpy the processor uses map_detections instead
+if np is not None:
+
+    def map_detections_batch(detections, data_dir):
+        users, counts = np.unique(
+            detections["user_id"][detections["visible"]], return_counts=True
+        )
+
+        return list(zip(users.tolist(), counts.tolist()))
+
+
+def reduce_detections(counts, data_dir, db):
+    # Update only the users present in this batch
+    db.executemany(
+        "INSERT INTO counts VALUES (?, ?) "
+        "ON CONFLICT (user_id) DO UPDATE SET count = count + excluded.count",
+        counts,
+    )
+
+
+def flush(db):
+    db.commit()
+
+    top = db.execute(
+        "SELECT user_id, count FROM counts ORDER BY count DESC LIMIT 10"
+    ).fetchall()
+    print("top 10 users: {}".format(top))
+
+
+def teardown(db):
+    # Changes not flushed yet belong to files which were not recorded as
+    # processed, so they are rolled back
+    db.rollback()
+    db.close()
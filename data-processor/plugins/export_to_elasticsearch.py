@@ -1,5 +1,10 @@
+import collections
+import datetime
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk
+from elasticsearch.helpers import streaming_bulk
 
 DETECTION_INDEX_NAME = "credo-detections"
 DETECTION_INDEX_CONFIG = {
@@ -44,9 +49,26 @@ PING_INDEX_CONFIG = {
 }
 
 
-ES_HOSTS = ["127.0.0.1"]
+# Settings can be overridden with environment variables, e.g. to point the
+# plugin at a test server or tune it for a bigger cluster
+ES_HOSTS = os.environ.get("CREDO_ES_HOSTS", "127.0.0.1").split(",")
+BULK_CHUNK_SIZE = int(os.environ.get("CREDO_ES_CHUNK_SIZE", 1000))
+BULK_MAX_BYTES = int(os.environ.get("CREDO_ES_MAX_BYTES", 20 * 1024 * 1024))
+BULK_THREADS = int(os.environ.get("CREDO_ES_THREADS", 4))
+BULK_MAX_RETRIES = int(os.environ.get("CREDO_ES_MAX_RETRIES", 8))
+BULK_INITIAL_BACKOFF = float(os.environ.get("CREDO_ES_INITIAL_BACKOFF", 2))
+REFRESH_INTERVAL = os.environ.get("CREDO_ES_REFRESH_INTERVAL", "1s")
+REPLICAS = int(os.environ.get("CREDO_ES_REPLICAS", 0))
+
+# With CREDO_ES_PARTITION set to "month" or "day", events are written to one
+# index per period of time_received (e.g. credo-detections-2020.01), all of
+# them reachable through an alias with the old index name
+PARTITION_FORMATS = {"month": "%Y.%m", "day": "%Y.%m.%d"}
+PARTITION = os.environ.get("CREDO_ES_PARTITION", "")
+if PARTITION and PARTITION not in PARTITION_FORMATS:
+    raise ValueError("CREDO_ES_PARTITION must be one of: month, day")
 
-es = Elasticsearch(ES_HOSTS, sniff_on_start=False)
+es = Elasticsearch(ES_HOSTS, sniff_on_start=False, maxsize=BULK_THREADS)
 
 
 def transform_detections(detections):
@@ -57,19 +79,172 @@ def transform_detections(detections):
         del d["latitude"]
         del d["longitude"]
 
+        # Frames may be lazy references to the processor's frame store
+        if d.get("frame_content") is not None:
+            d["frame_content"] = str(d["frame_content"])
+
         yield d
 
 
-def process_detections(detections, data_dir):
-    es.indices.create(DETECTION_INDEX_NAME, body=DETECTION_INDEX_CONFIG, ignore=400)
-    bulk(
+def index_name(index, event):
+    if not PARTITION or event.get("time_received") is None:
+        return index
+
+    time_received = datetime.datetime.fromtimestamp(
+        event["time_received"] / 1000, datetime.timezone.utc
+    )
+    return "{}-{}".format(index, time_received.strftime(PARTITION_FORMATS[PARTITION]))
+
+
+def to_actions(events, index):
+    # Event ids are used as document ids, so indexing a file again overwrites
+    # its documents instead of duplicating them
+    for event in events:
+        yield {
+            "_index": index_name(index, event),
+            "_id": event["id"],
+            "_source": event,
+        }
+
+
+def chunked(actions, size):
+    chunk = []
+    for action in actions:
+        chunk.append(action)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def index_chunk(chunk, index):
+    # Documents rejected with 429 (queue full) are retried with exponential
+    # backoff by streaming_bulk, other failures are counted and reported.
+    indexed = 0
+    errors = []
+
+    for ok, item in streaming_bulk(
         es,
-        transform_detections(detections),
-        index=DETECTION_INDEX_NAME,
-        raise_on_exception=False,
+        chunk,
+        index=index,
+        chunk_size=BULK_CHUNK_SIZE,
+        max_chunk_bytes=BULK_MAX_BYTES,
+        max_retries=BULK_MAX_RETRIES,
+        initial_backoff=BULK_INITIAL_BACKOFF,
+        raise_on_error=False,
+    ):
+        if ok:
+            indexed += 1
+        else:
+            errors.append(item)
+
+    return indexed, errors
+
+
+def bulk_index(actions, index):
+    # Chunks are sent by several threads at once, with a bounded number of
+    # chunks in flight so memory use does not depend on the input size.
+    indexed = 0
+    errors = []
+
+    def collect(future):
+        nonlocal indexed
+        chunk_indexed, chunk_errors = future.result()
+        indexed += chunk_indexed
+        errors.extend(chunk_errors)
+
+    with ThreadPoolExecutor(max_workers=BULK_THREADS) as executor:
+        pending = collections.deque()
+
+        for chunk in chunked(actions, BULK_CHUNK_SIZE):
+            pending.append(executor.submit(index_chunk, chunk, index))
+
+            if len(pending) >= BULK_THREADS * 2:
+                collect(pending.popleft())
+
+        while pending:
+            collect(pending.popleft())
+
+    print("indexed {} documents into {}, {} failed".format(indexed, index, len(errors)))
+    if errors:
+        print("first failure: {}".format(errors[0]))
+
+    return indexed, len(errors)
+
+
+def create_index(index, config):
+    if not PARTITION:
+        es.indices.create(index, body=config, ignore=400)
+        return
+
+    # Indices for each period are created by Elasticsearch on first write,
+    # the template gives them the mapping and adds them to the alias
+    es.indices.put_template(
+        name=index,
+        body=dict(config, index_patterns=[index + "-*"], aliases={index: {}}, order=1),
     )
 
 
-def process_pings(pings, data_dir):
-    es.indices.create(PING_INDEX_NAME, body=PING_INDEX_CONFIG, ignore=400)
-    bulk(es, pings, index=PING_INDEX_NAME, raise_on_exception=False)
+def setup(data_dir):
+    create_index(DETECTION_INDEX_NAME, DETECTION_INDEX_CONFIG)
+    create_index(PING_INDEX_NAME, PING_INDEX_CONFIG)
+
+    # Refreshing and replicating while loading in bulk only slows indexing
+    # down, both are set to the configured values in teardown. They are not
+    # read back from the indices, which still have them turned off after a
+    # run that was killed.
+    indices = ",".join(
+        "{}*".format(index) if PARTITION else index
+        for index in [DETECTION_INDEX_NAME, PING_INDEX_NAME]
+    )
+    es.indices.put_settings(
+        index=indices,
+        body={"index": {"refresh_interval": "-1", "number_of_replicas": 0}},
+        allow_no_indices=True,
+    )
+
+    return {"indices": indices, "indexed": 0, "failed": 0}
+
+
+def process_detections(detections, data_dir, state):
+    indexed, failed = bulk_index(
+        to_actions(transform_detections(detections), DETECTION_INDEX_NAME),
+        DETECTION_INDEX_NAME,
+    )
+    state["indexed"] += indexed
+    state["failed"] += failed
+
+
+def process_pings(pings, data_dir, state):
+    indexed, failed = bulk_index(to_actions(pings, PING_INDEX_NAME), PING_INDEX_NAME)
+    state["indexed"] += indexed
+    state["failed"] += failed
+
+
+def flush(state):
+    # Refreshing is turned off while the plugin runs, so documents indexed so
+    # far are made searchable at every checkpoint. Otherwise they would only
+    # show up after teardown, which in --watch mode only comes when the
+    # processor is stopped.
+    es.indices.refresh(index=state["indices"], allow_no_indices=True)
+
+
+def teardown(state):
+    es.indices.put_settings(
+        index=state["indices"],
+        body={
+            "index": {
+                "refresh_interval": REFRESH_INTERVAL,
+                "number_of_replicas": REPLICAS,
+            }
+        },
+        allow_no_indices=True,
+    )
+
+    print(
+        "indexed {} documents in total, {} failed".format(
+            state["indexed"], state["failed"]
+        )
+    )
@@ -0,0 +1,320 @@
+import bisect
+import collections
+import json
+import math
+import os
+import pickle
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DATA_TYPES = ["detection"]
+
+# Detections of different devices are coincident when they are at most
+# WINDOW_MS apart in time and DISTANCE_KM apart on the ground. Groups of
+# coincident detections from at least MIN_DEVICES devices are appended to
+# coincidences.jsonl in the data directory.
+WINDOW_MS = int(os.environ.get("CREDO_COINCIDENCE_WINDOW_MS", 1000))
+DISTANCE_KM = float(os.environ.get("CREDO_COINCIDENCE_DISTANCE_KM", 1))
+MIN_DEVICES = int(os.environ.get("CREDO_COINCIDENCE_MIN_DEVICES", 2))
+
+# Detections are often uploaded long after they happened. The search only
+# moves past detections older than the newest received one by LATENESS_MS,
+# detections arriving later than that are counted as late and skipped.
+LATENESS_MS = int(os.environ.get("CREDO_COINCIDENCE_LATENESS_MS", 24 * 3600 * 1000))
+
+EARTH_RADIUS_KM = 6371.0
+CELL_DEGREES = DISTANCE_KM / (math.pi * EARTH_RADIUS_KM / 180)
+
+# Cells of longitude wrap around at 180 degrees, so they are made slightly
+# wider to fit a whole number of them around the globe
+LONGITUDE_CELLS = max(int(360 / CELL_DEGREES), 1)
+LONGITUDE_CELL_DEGREES = 360 / LONGITUDE_CELLS
+
+# Fields of the detection tuples kept by the plugin, sorted by timestamp
+FIELDS = ["timestamp", "id", "device_id", "user_id", "latitude", "longitude"]
+TIMESTAMP, ID, DEVICE_ID, USER_ID, LATITUDE, LONGITUDE = range(len(FIELDS))
+
+# Active detections are [detection, group] lists and groups are
+# [members, last timestamp, done] lists, so the state pickles without
+# referring to this module.
+MEMBERS, LAST, DONE = range(3)
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1, math.sqrt(a)))
+
+
+def polar(row):
+    # Rows reaching within a cell of a pole are kept as a single cell covering
+    # every longitude
+    return max((row + 1) * CELL_DEGREES, -row * CELL_DEGREES) > 90 - CELL_DEGREES
+
+
+def column_of(detection):
+    return (
+        int(math.floor(detection[LONGITUDE] / LONGITUDE_CELL_DEGREES)) % LONGITUDE_CELLS
+    )
+
+
+def cell_of(detection):
+    row = int(math.floor(detection[LATITUDE] / CELL_DEGREES))
+    return row, 0 if polar(row) else column_of(detection)
+
+
+def neighbour_cells(detection):
+    # Degrees of longitude shrink towards the poles, so more cells are
+    # searched east and west of the detection. The reach is worked out for
+    # the farthest latitude from the equator a detection in range can have.
+    row = int(math.floor(detection[LATITUDE] / CELL_DEGREES))
+    far = math.radians(min(90, abs(detection[LATITUDE]) + CELL_DEGREES))
+    spread = math.sin(math.radians(CELL_DEGREES) / 2) / max(math.cos(far), 1e-12)
+    if spread < 1:
+        reach = math.degrees(2 * math.asin(spread)) / LONGITUDE_CELL_DEGREES
+        reach = min(int(math.ceil(reach)), LONGITUDE_CELLS // 2)
+    else:
+        reach = LONGITUDE_CELLS // 2
+
+    x = column_of(detection)
+    xs = set((x + dx) % LONGITUDE_CELLS for dx in range(-reach, reach + 1))
+
+    for y in (row - 1, row, row + 1):
+        if polar(y):
+            yield y, 0
+        else:
+            for cell_x in xs:
+                yield y, cell_x
+
+
+def merge(group, other):
+    if len(group[MEMBERS]) < len(other[MEMBERS]):
+        group, other = other, group
+
+    for entry in other[MEMBERS]:
+        entry[1] = group
+    group[MEMBERS].extend(other[MEMBERS])
+    group[LAST] = max(group[LAST], other[LAST])
+    other[DONE] = True
+
+    return group
+
+
+def describe(group):
+    detections = sorted(entry[0] for entry in group[MEMBERS])
+
+    return {
+        "start": detections[0][TIMESTAMP],
+        "end": detections[-1][TIMESTAMP],
+        "devices": len(set(d[DEVICE_ID] for d in detections)),
+        "detections": [dict(zip(FIELDS, d)) for d in detections],
+    }
+
+
+def expire(state, cutoff):
+    # Drops detections which can no longer be coincident with anything not
+    # swept yet, and completes groups whose every member was dropped
+    window = state["window"]
+    grid = state["grid"]
+
+    while window and window[0][0][TIMESTAMP] < cutoff:
+        entry = window.popleft()
+
+        # Cells are filled in time order like the window, so the entry is
+        # the first one of its cell
+        cell = cell_of(entry[0])
+        grid[cell].popleft()
+        if not grid[cell]:
+            del grid[cell]
+
+        group = entry[1]
+        if group is not None and not group[DONE] and group[LAST] < cutoff:
+            group[DONE] = True
+            if len(set(e[0][DEVICE_ID] for e in group[MEMBERS])) >= MIN_DEVICES:
+                state["found"].append(describe(group))
+
+
+def add(state, detection):
+    # Each detection is compared only with detections of the last WINDOW_MS
+    # in its own and neighbouring grid cells
+    expire(state, detection[TIMESTAMP] - WINDOW_MS)
+
+    group = None
+    for cell in neighbour_cells(detection):
+        for entry in state["grid"].get(cell, ()):
+            other = entry[0]
+            if other[DEVICE_ID] == detection[DEVICE_ID]:
+                continue
+
+            if (
+                distance_km(
+                    detection[LATITUDE],
+                    detection[LONGITUDE],
+                    other[LATITUDE],
+                    other[LONGITUDE],
+                )
+                > DISTANCE_KM
+            ):
+                continue
+
+            if entry[1] is None:
+                entry[1] = [[entry], other[TIMESTAMP], False]
+
+            if group is None:
+                group = entry[1]
+            elif entry[1] is not group:
+                group = merge(group, entry[1])
+
+    entry = [detection, group]
+    if group is not None:
+        group[MEMBERS].append(entry)
+        group[LAST] = max(group[LAST], detection[TIMESTAMP])
+
+    state["window"].append(entry)
+    state["grid"].setdefault(cell_of(detection), collections.deque()).append(entry)
+
+
+def sweep(state, horizon):
+    pending = state["pending"]
+    pending.sort()
+
+    ready = bisect.bisect_left(pending, (horizon,))
+    for detection in pending[:ready]:
+        add(state, detection)
+
+    del pending[:ready]
+    state["swept"] = horizon
+
+
+def state_path(data_dir):
+    return data_dir + "/coincidences.state"
+
+
+def output_path(data_dir):
+    return data_dir + "/coincidences.jsonl"
+
+
+def setup(data_dir):
+    if os.path.isfile(state_path(data_dir)):
+        with open(state_path(data_dir), "rb") as f:
+            state = pickle.load(f)
+
+        # Cells depend on the configured distance and on how they were
+        # computed by the version which saved the state
+        grid = state["grid"] = {}
+        for entry in state["window"]:
+            grid.setdefault(cell_of(entry[0]), collections.deque()).append(entry)
+    else:
+        state = {
+            "pending": [],
+            "window": collections.deque(),
+            "grid": {},
+            "swept": -math.inf,
+            "received": -math.inf,
+            "late": 0,
+            "output_size": 0,
+        }
+
+        # Without a state the search starts over and appends to earlier
+        # results instead of replacing them
+        if os.path.isfile(output_path(data_dir)):
+            state["output_size"] = os.path.getsize(output_path(data_dir))
+
+    # Results written after the last flush belong to files which will be
+    # processed again
+    if os.path.isfile(output_path(data_dir)):
+        with open(output_path(data_dir), "r+") as f:
+            f.truncate(state["output_size"])
+
+    state["found"] = []
+    state["data_dir"] = data_dir
+    return state
+
+
+def map_detections(detections, data_dir):
+    # Keeps only what the search needs from visible, located detections, this
+    # part may run in a worker process
+    located = []
+    received = None
+
+    for d in detections:
+        if d.get("time_received") is not None:
+            received = max(received or d["time_received"], d["time_received"])
+
+        if (
+            d.get("visible")
+            and d.get("latitude") is not None
+            and d.get("longitude") is not None
+        ):
+            located.append(tuple(d.get(field) for field in FIELDS))
+
+    return located, received
+
+
+# Without numpy the processor uses map_detections instead
+if np is not None:
+
+    def map_detections_batch(detections, data_dir):
+        located = (
+            detections["visible"]
+            & ~np.isnan(detections["latitude"])
+            & ~np.isnan(detections["longitude"])
+        )
+        received = int(detections["time_received"].max()) if len(located) else None
+
+        return (
+            list(zip(*(detections[field][located].tolist() for field in FIELDS))),
+            received,
+        )
+
+
+def reduce_detections(partial, data_dir, state):
+    detections, received = partial
+
+    for detection in detections:
+        if detection[TIMESTAMP] < state["swept"]:
+            state["late"] += 1
+        else:
+            state["pending"].append(detection)
+
+    if received is not None:
+        state["received"] = max(state["received"], received)
+
+    horizon = state["received"] - LATENESS_MS
+    if horizon > state["swept"]:
+        sweep(state, horizon)
+
+
+def flush(state):
+    data_dir = state["data_dir"]
+    found = state.pop("found")
+
+    with open(output_path(data_dir), "a") as f:
+        for group in found:
+            f.write(json.dumps(group) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+        state["output_size"] = f.tell()
+
+    del state["data_dir"]
+    try:
+        with open(state_path(data_dir) + ".tmp", "wb") as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(state_path(data_dir) + ".tmp", state_path(data_dir))
+    finally:
+        state["data_dir"] = data_dir
+        state["found"] = []
+
+    print(
+        "found {} coincidences, {} detections waiting, {} late".format(
+            len(found), len(state["pending"]) + len(state["window"]), state["late"]
+        )
+    )
@@ -1,8 +1,17 @@
 import argparse
-import json
+import os
+import re
+import sqlite3
+import sys
 
 from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk
+from elasticsearch.helpers import streaming_bulk
+
+# Mapping files are written by the exporter, whose helpers read them
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data-exporter")
+)
+import credo_common  # noqa: E402
 
 USER_INDEX_NAME = "credo-users"
 USER_INDEX_CONFIG = {
@@ -36,12 +45,30 @@ TEAM_INDEX_CONFIG = {
     "mappings": {"properties": {"id": {"type": "long"}, "name": {"type": "keyword"}}},
 }
 
+MAPPINGS = {
+    "users": (USER_INDEX_NAME, USER_INDEX_CONFIG),
+    "devices": (DEVICE_INDEX_NAME, DEVICE_INDEX_CONFIG),
+    "teams": (TEAM_INDEX_NAME, TEAM_INDEX_CONFIG),
+}
+
+MAPPING_START = re.compile(r'\s*\{\s*"(\w+)"\s*:\s*\[')
+
 parser = argparse.ArgumentParser(
     description="Tool for exporting CREDO mappings to Elasticsearch"
 )
 
 parser.add_argument("--host", help="Elasticsearch host", default="127.0.0.1")
 parser.add_argument("--clear", help="Clear previously stored data", action="store_true")
+parser.add_argument(
+    "--diff",
+    help="Only send entries which changed since the previous run with --diff",
+    action="store_true",
+)
+parser.add_argument(
+    "--state",
+    help="Path to the database of hashes used by --diff "
+    "(default: mapping_hashes.sqlite next to the file)",
+)
 parser.add_argument("file", help="File to read data from", default="user_mapping.json")
 
 args = parser.parse_args()
@@ -49,39 +76,93 @@ args = parser.parse_args()
 es = Elasticsearch(args.host, sniff_on_start=False)
 
 
-def export_user_mapping(users):
-    es.indices.create(USER_INDEX_NAME, body=USER_INDEX_CONFIG, ignore=400)
-    bulk(es, users, index=USER_INDEX_NAME, raise_on_exception=False)
-
+def mapping_type(f):
+    # Mapping exports hold a single array named after the mapping type
+    match = MAPPING_START.match(f.read(1024))
+    f.seek(0)
+    if match is None or match.group(1) not in MAPPINGS:
+        raise ValueError("Unknown mapping file format")
+    return match.group(1)
+
+
+def open_state():
+    path = args.state or os.path.join(
+        os.path.dirname(os.path.abspath(args.file)), "mapping_hashes.sqlite"
+    )
+    db = sqlite3.connect(path)
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS hashes ("
+        "  index_name TEXT NOT NULL,"
+        "  id INTEGER NOT NULL,"
+        "  digest BLOB NOT NULL,"
+        "  PRIMARY KEY (index_name, id)"
+        ") WITHOUT ROWID"
+    )
+    return db
+
+
+def changed_entries(entries, index, db, pending):
+    # Skips entries whose hash matches the one stored when they were last
+    # indexed, remembering hashes of the others until they are indexed
+    for entry in entries:
+        digest = credo_common.entry_digest(entry)
+        row = db.execute(
+            "SELECT digest FROM hashes WHERE index_name = ? AND id = ?",
+            (index, entry["id"]),
+        ).fetchone()
+        if row is not None and row[0] == digest:
+            continue
+
+        pending[str(entry["id"])] = digest
+        yield entry
+
+
+def export_mapping(entries, index, config, db=None):
+    es.indices.create(index, body=config, ignore=400)
+
+    pending = {}
+    if db is not None:
+        entries = changed_entries(entries, index, db, pending)
+
+    # Mapping ids are used as document ids, so entries sent again replace
+    # their previous version
+    actions = ({"_id": entry["id"], "_source": entry} for entry in entries)
+
+    indexed = 0
+    failed = 0
+    for ok, item in streaming_bulk(es, actions, index=index, raise_on_error=False):
+        if not ok:
+            failed += 1
+            continue
+
+        indexed += 1
+        digest = pending.pop(item["index"]["_id"], None)
+        if digest is not None:
+            db.execute(
+                "INSERT OR REPLACE INTO hashes (index_name, id, digest) VALUES (?, ?, ?)",
+                (index, int(item["index"]["_id"]), digest),
+            )
+
+    if db is not None:
+        db.commit()
+
+    print("Indexed {} entries into {}, {} failed".format(indexed, index, failed))
 
-def export_device_mapping(devices):
-    es.indices.create(DEVICE_INDEX_NAME, body=DEVICE_INDEX_CONFIG, ignore=400)
-    bulk(es, devices, index=DEVICE_INDEX_NAME, raise_on_exception=False)
 
+def main():
+    db = open_state() if args.diff else None
 
-def export_team_mapping(teams):
-    es.indices.create(TEAM_INDEX_NAME, body=TEAM_INDEX_CONFIG, ignore=400)
-    bulk(es, teams, index=TEAM_INDEX_NAME, raise_on_exception=False)
+    with open(args.file) as f:
+        key = mapping_type(f)
+        index, config = MAPPINGS[key]
 
+        if args.clear:
+            es.indices.delete(index=index, ignore=[400, 404])
+            if db is not None:
+                db.execute("DELETE FROM hashes WHERE index_name = ?", (index,))
+                db.commit()
 
-def main():
-    with open(args.file) as f:
-        mapping = json.load(f)
-
-        if "users" in mapping.keys():
-            if args.clear:
-                es.indices.delete(index=USER_INDEX_NAME, ignore=[400, 404])
-            export_user_mapping(mapping["users"])
-
-        if "devices" in mapping.keys():
-            if args.clear:
-                es.indices.delete(index=DEVICE_INDEX_NAME, ignore=[400, 404])
-            export_device_mapping(mapping["devices"])
-
-        if "teams" in mapping.keys():
-            if args.clear:
-                es.indices.delete(index=TEAM_INDEX_NAME, ignore=[400, 404])
-            export_team_mapping(mapping["teams"])
+        export_mapping(credo_common.iter_array(f, key), index, config, db)
 
 
 if __name__ == "__main__":